@@ -0,0 +1,177 @@
+"""Benchmarks of the g-function hot path on the semibatch reactor model.
+
+Every case is timed (best of --repeat runs) and run once more under tracemalloc for its peak
+memory. The results are written to a JSON file, which can be compared against a baseline:
+
+    python benchmarks/run_benchmarks.py --output baseline.json
+    python benchmarks/run_benchmarks.py --compare baseline.json --tolerance 1.3
+
+The comparison exits with status 1 if the time or peak memory of a case exceeds the baseline
+by more than the tolerance factor. The synthetic solver stands in for GAMS, so solve times only
+cover the work done by pyds and Pyomo around the solver call.
+"""
+from time import perf_counter
+from datetime import datetime
+import argparse
+import tempfile
+import tracemalloc
+import platform
+import json
+import sys
+
+import numpy as np
+import pyomo
+import pyomo.environ
+
+import pyds.utils as utils
+from pyds.run import TwoStageManager, ThreeStageManager
+import semibatch
+import synthetic_solver
+
+GRIDS = {
+    'quick': {'n_stages': [2, 3], 'n_d': [1, 4], 'n_p': [5, 20]},
+    'full': {'n_stages': [2, 3], 'n_d': [1, 4, 16], 'n_p': [5, 20, 50]},
+}
+
+def measure(fn, repeat, setup=None):
+    """Time fn, if given the result of setup is passed to fn and not timed"""
+    get_args = lambda: () if setup is None else (setup(),)
+    times = []
+    for i in range(repeat):
+        args = get_args()
+        t0 = perf_counter()
+        fn(*args)
+        times.append(perf_counter() - t0)
+    args = get_args()
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'time': min(times), 'mean time': float(np.mean(times)), 'peak memory': peak}
+
+def get_manager(n_stages, output_folder):
+    config = semibatch.get_config(n_stages, output_folder)
+    if n_stages == 2:
+        return TwoStageManager(config)
+    return ThreeStageManager(config)
+
+def get_input(n_stages, d, p):
+    n_d, n_p = len(d), len(p)
+    if n_stages == 2:
+        return [1, n_p], {0: d[0:1], 1: p}
+    return [1, n_d, n_p], {1: d, 2: np.tile(p, (n_d, 1))}
+
+def run_case(n_stages, n_d, n_p, repeat, output_folder, components=True):
+    """Benchmark g at one grid point, and the components of g at its branching factors"""
+    d, p = semibatch.get_samples(n_d, n_p)
+    m = get_manager(n_stages, output_folder)
+    BFs, input = get_input(n_stages, d, p)
+    m._set_model(BFs)
+    model = m.model
+
+    def build():
+        ef = utils.create_EF(m.stage_rules, BFs)
+        m.model_transformation(ef)
+
+    #Grown by a quarter of the final stage, against the build of the full EF
+    def build_smaller():
+        small_BFs = BFs[:-1] + [max(1, (3*BFs[-1])//4)]
+        return utils.create_EF(m.stage_rules, small_BFs, model_transformation=m.model_transformation)
+
+    def export():
+        for idx in utils.get_all_idx(model.BFs):
+            m.simulator._export_trajectories_to_model(model, idx)
+
+    def g():
+        m.g(d, p)
+
+    utils.load_input(model, m.input_map, input)
+    m.simulator.simulate_all_scenarios(model, input)
+    cases = {
+        'create_EF': build,
+        'load_input': lambda: utils.load_input(model, m.input_map, input),
+        'simulate_all_scenarios': lambda: m.simulator.simulate_all_scenarios(model, input),
+        '_export_trajectories_to_model': export,
+        'Solver.solve': lambda: m.solver.solve(),
+    }
+    results = {}
+    if components:
+        for name, fn in cases.items():
+            results['stages={},BFs={}/{}'.format(n_stages, BFs, name)] = measure(fn, repeat)
+        results['stages={},BFs={}/grow_EF'.format(n_stages, BFs)] = measure(
+            lambda ef: utils.grow_EF(ef, BFs), repeat, setup=build_smaller)
+    #Steady state, the model is already built
+    g()
+    key = 'stages={},n_d={},n_p={}/{}.g'.format(n_stages, n_d, n_p, type(m).__name__)
+    results[key] = measure(g, repeat)
+    return results
+
+def run(grid, repeat):
+    output_folder = tempfile.mkdtemp(prefix='pyds_benchmarks_')
+    results = {}
+    #The components only depend on the branching factors, which are shared by some grid points
+    BFs_done = set()
+    for n_stages in grid['n_stages']:
+        for n_d in grid['n_d']:
+            for n_p in grid['n_p']:
+                print('Running stages={},n_d={},n_p={}'.format(n_stages, n_d, n_p), flush=True)
+                BFs = tuple(get_input(n_stages, np.empty((n_d, 2)), np.empty((n_p, 4)))[0])
+                results.update(run_case(n_stages, n_d, n_p, repeat, output_folder, 
+                    components=(n_stages, BFs) not in BFs_done))
+                BFs_done.add((n_stages, BFs))
+    return {
+        'meta': {
+            'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pyomo': pyomo.version.version,
+            'numpy': np.__version__,
+            'repeat': repeat,
+        },
+        'results': results
+    }
+
+def compare(results, baseline, tolerance):
+    """Print the ratios to the baseline and return the cases which regressed"""
+    regressions = []
+    print('{:<70}{:>10}{:>10}'.format('case', 'time', 'memory'))
+    for key, result in results['results'].items():
+        if key not in baseline['results']:
+            continue
+        base = baseline['results'][key]
+        time_ratio = result['time']/base['time']
+        memory_ratio = result['peak memory']/max(base['peak memory'], 1)
+        flag = ''
+        if time_ratio > tolerance or memory_ratio > tolerance:
+            regressions.append(key)
+            flag = ' <'
+        print('{:<70}{:>10.2f}{:>10.2f}{}'.format(key, time_ratio, memory_ratio, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the g-function hot path of pyds')
+    parser.add_argument('--grid', choices=GRIDS.keys(), default='quick')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=1.3,
+        help='Maximum ratio of time or peak memory to the baseline')
+    args = parser.parse_args()
+
+    results = run(GRIDS[args.grid], args.repeat)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions):
+            print('{} regressions beyond a factor {}'.format(len(regressions), args.tolerance))
+            sys.exit(1)
+    else:
+        for key, result in results['results'].items():
+            print('{:<70}{:>12.4f} s{:>12.1f} kB'.format(key, result['time'], result['peak memory']/1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import pyomo.environ as pyo
+from pyomo import dae
+import numpy as np
+
+from pyds.utils import add_BigMConstraint
+
+#Semibatch reactor of run_twostage.py and run_threestage.py, with the design inputs t_f and T
+#at the design stage and the kinetic parameters at the final stage.
+
+def control_rule(m, stage=None):
+    m.t = dae.ContinuousSet(bounds=(0,1)) #Normalised time
+    m.u = pyo.Var(m.t, initialize=0)
+    m.dudt = dae.DerivativeVar(m.u, initialize=0, wrt=m.t)
+    m.F_in = pyo.Var(m.t, initialize=0, bounds=(0, 2.5))
+
+    m.u[0].fix(0)
+    def r_F_in(_m, t):
+        return _m.F_in[t] == _m.dudt[t]
+    m.c_F_in = pyo.Constraint(m.t, rule=r_F_in)
+    m.F_in_default = pyo.Suffix(direction=pyo.Suffix.LOCAL)
+    m.F_in_default[m.F_in] = {0:2.5, .2:0}
+
+def design_rule(m, stage=None):
+    m.T = pyo.Param(initialize=0, mutable=True)
+    m.t_f = pyo.Param(initialize=0, mutable=True)
+
+def twostage_design_rule(m, stage=None):
+    control_rule(m, stage)
+    design_rule(m, stage)
+
+def parameter_rule(m, stage):
+    control = stage[0]
+    design = stage[len(stage)-1]
+    t = control.t
+    t_f = design.t_f
+    T = design.T
+    u = control.u
+    F_in = control.F_in
+
+    m.I = pyo.Set(initialize=['A', 'B', 'C'])
+    m.E1 = pyo.Param(mutable=True, initialize=0)
+    m.E2 = pyo.Param(mutable=True, initialize=0)
+    m.k1 = pyo.Param(mutable=True, initialize=0)
+    m.k2 = pyo.Param(mutable=True, initialize=0)
+
+    m.c = pyo.Var(m.I, t, bounds=(0, 1E8), initialize=0)
+    m.dcdt = dae.DerivativeVar(m.c, wrt=t)
+
+    R = 1
+    def r_mb1(_m, t):
+        return _m.dcdt['A',t]/t_f == -2*_m.k1*pyo.exp(-_m.E1/(R*T))*_m.c['A',t]**2 + F_in[t]
+    def r_mb2(_m, t):
+        return _m.dcdt['B',t]/t_f == _m.k1*pyo.exp(-_m.E1/(R*T))*_m.c['A',t]**2 \
+            - _m.k2*pyo.exp(-_m.E2/(R*T))*_m.c['B',t]
+    def r_mb3(_m, t):
+        return  _m.dcdt['C',t]/t_f  == _m.k2*pyo.exp(-_m.E2/(R*T))*_m.c['B',t]
+    m.mb1 = pyo.Constraint(t, rule=r_mb1)
+    m.mb2 = pyo.Constraint(t, rule=r_mb2)
+    m.mb3 = pyo.Constraint(t, rule=r_mb3)
+
+    m.g1 = pyo.Var(initialize=0)
+    m.g2 = pyo.Var(initialize=0)
+    def r_cqa1(_m):
+        return _m.g1 == (0.8 -(_m.c['B',1] + 1E-2)/(_m.c['A', 1]+_m.c['B',1]+_m.c['C',1]+ 1E-2))
+    def r_cqa2(_m):
+        return _m.g2 == -(100*_m.c['B',1] - 20*(_m.c['A',0]+ u[1]*t_f) - 128*(t_f + 30))
+    m.c_g1 = pyo.Constraint(rule=r_cqa1)
+    m.c_g2 = pyo.Constraint(rule=r_cqa2)
+
+    m.bigM_constant = pyo.Param([1,2], initialize={1: 1E2, 2: 1E7})
+    add_BigMConstraint(m, 'cqa1', m.bigM_constant[1], expr=m.g1<=0)
+    add_BigMConstraint(m, 'cqa2', m.bigM_constant[2], expr=m.g2<=0)
+    m.c['A',0].fix(2E3) #mol/L
+    m.c['B',0].fix(0)
+    m.c['C',0].fix(0)
+
+def apply_collocation(m):
+    discretizer = pyo.TransformationFactory('dae.collocation')
+    discretizer.apply_to(m, nfe=8, ncp=3)
+    discretizer.reduce_collocation_points(m, var=m.F_in, ncp=1, contset=m.t)
+    discretizer.reduce_collocation_points(m, var=m.u, ncp=1, contset=m.t)
+
+def get_config(n_stages, output_folder, solver='pyds_synthetic'):
+    """Config of a TwoStageManager (n_stages=2) or ThreeStageManager (n_stages=3)"""
+    if n_stages == 2:
+        stage_rules = [twostage_design_rule, parameter_rule]
+    else:
+        stage_rules = [control_rule, design_rule, parameter_rule]
+    design_stage = n_stages - 2
+    return {
+        'problem': {
+            'stage rules': stage_rules,
+            'model transformation': apply_collocation,
+            'input map': {design_stage: ['t_f', 'T'], design_stage+1: ['E1', 'E2', 'k1', 'k2']},
+            'output map': {design_stage+1: ['c']},
+            'output folder': output_folder
+        },
+        'solver': {
+            'name': solver,
+            'solve trajectories': False,
+            'tee': False,
+            'io options': {'warmstart': True},
+            'save output': False,
+            'save solution state': False,
+            'warn infeasible': False,
+        },
+        'simulator': {
+            'enabled': True,
+            'package': 'scipy',
+            'suffix name': 'F_in_default',
+            'save output': False,
+            'kwargs': {}
+        }
+    }
+
+def get_samples(n_d, n_p, seed=12341234):
+    """Design points in the bounds of the run scripts and normally distributed parameter samples"""
+    rng = np.random.default_rng(seed)
+    d = np.column_stack([rng.uniform(250, 400, n_d), rng.uniform(250, 300, n_d)])
+    p = np.column_stack([rng.normal(2.5E3, 2.5E1, n_p), rng.normal(5E3, 5E1, n_p),
+        rng.normal(6.409E-2, 6.409E-4, n_p), rng.normal(9.938E3, 9.938E1, n_p)])
+    return d, p
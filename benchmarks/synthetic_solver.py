@@ -0,0 +1,36 @@
+from pyomo.opt import SolverFactory, SolverResults, SolverStatus, TerminationCondition
+from pyomo.core.base import Constraint, value
+from time import process_time
+
+import pyds.utils as utils
+
+@SolverFactory.register('pyds_synthetic', doc='Synthetic stand-in for a local NLP solver')
+class SyntheticSolver:
+    """Stand-in for a local NLP solver, so benchmarks run without GAMS or an NLP solver.
+
+    The indicator variable of every final scenario is set to 1 if a big-M constraint is violated
+    at the current (initial) point, and 0 otherwise. All active constraint bodies are evaluated
+    once, like a problem writer would. The cost of the solver itself is not represented.
+    """
+    def __init__(self, **kwds):
+        self.options = kwds.get('options', {})
+
+    def available(self, exception_flag=True):
+        return True
+
+    def solve(self, model, **kwds):
+        t0 = process_time()
+        for c in model.component_data_objects(Constraint, active=True, descend_into=True):
+            value(c.body, exception=False)
+
+        indicator_vars, mask = utils.get_indicator_vars(model)
+        residuals = utils.get_bigM_residuals(model)[mask]
+        for var, r in zip(indicator_vars, residuals):
+            if not var.fixed:
+                var.set_value(0 if r <= 0 else 1, skip_validation=True)
+
+        results = SolverResults()
+        results.solver.status = SolverStatus.ok
+        results.solver.termination_condition = TerminationCondition.optimal
+        results.solver.user_time = process_time() - t0
+        return results
@@ -0,0 +1,150 @@
+from pyomo.core.base import value
+from pyomo.core.expr.numvalue import native_numeric_types
+from pyomo.core.expr.visitor import StreamBasedExpressionVisitor
+from pyomo.core.expr.numeric_expr import UnaryFunctionExpression
+from pyomo.core.expr.template_expr import IndexTemplate
+from pyomo.dae.diffvar import DAE_Error
+from scipy.integrate import solve_ivp
+
+import numpy as np
+
+_numpy_functions = {
+    'exp': np.exp, 'log': np.log, 'log10': np.log10, 'sqrt': np.sqrt, 'abs': np.abs,
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'asin': np.arcsin, 'acos': np.arccos,
+    'atan': np.arctan, 'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh,
+    'asinh': np.arcsinh, 'acosh': np.arccosh, 'atanh': np.arctanh,
+    'floor': np.floor, 'ceil': np.ceil
+}
+
+class _BatchEvaluator(StreamBasedExpressionVisitor):
+    """Evaluate a pyomo expression with numpy arrays substituted for some of its leaves."""
+    def __init__(self, leaves):
+        super().__init__()
+        self.leaves = leaves
+
+    def beforeChild(self, node, child, child_idx):
+        if type(child) in native_numeric_types:
+            return False, child
+        if id(child) in self.leaves:
+            return False, self.leaves[id(child)]
+        if type(child) is IndexTemplate or not child.is_expression_type():
+            return False, value(child)
+        return True, None
+
+    def exitNode(self, node, data):
+        if isinstance(node, UnaryFunctionExpression):
+            return _numpy_functions[node.getname()](data[0])
+        return node._apply_operation(data)
+
+    def evaluate(self, expr):
+        if id(expr) in self.leaves:
+            return self.leaves[id(expr)]
+        if type(expr) in native_numeric_types or not expr.is_expression_type():
+            return value(expr)
+        return self.walk_expression(expr)
+
+
+class BatchSimulator:
+    """Integrate the ODEs of a pyomo Simulator for many parameter vectors in one stacked system.
+
+    The right-hand sides extracted by the pyomo Simulator (scipy package) are evaluated with the
+    states and input parameters of all N scenarios as numpy arrays. The stacked system is
+    integrated with a single call to scipy.integrate.solve_ivp per input switching interval.
+
+    Args:
+        simulator_obj (pyomo.dae.Simulator): Simulator of the flattened model, scipy package.
+        params (list of ParamData): Input parameters, in the order of the input columns.
+        options (dict): Keyword arguments for solve_ivp. LSODA with a block-banded Jacobian
+            is used by default.
+    """
+    def __init__(self, simulator_obj, params, options=None):
+        if simulator_obj._intpackage != 'scipy':
+            raise DAE_Error('Batch simulation is only available for the scipy package')
+        self.simulator_obj = simulator_obj
+        self.params = list(params)
+        self.n_states = len(simulator_obj._diffvars)
+        self.options = {'method': 'LSODA', 'rtol': 1e-6, 'atol': 1e-12}
+        if options is not None:
+            self.options.update(options)
+        if self.options['method'] == 'LSODA':
+            #The Jacobian of the stacked system is block diagonal
+            self.options.setdefault('lband', self.n_states-1)
+            self.options.setdefault('uband', self.n_states-1)
+
+    def simulate(self, inputs, numpoints=None, tstep=None, varying_inputs=None, **kwargs):
+        """Simulate all rows of inputs.
+
+        Args:
+            inputs (2d array): Input parameter values, one row per scenario
+            numpoints, tstep, varying_inputs: As in pyomo.dae.Simulator.simulate
+
+        Returns:
+            tuple of 1d array, 3d array: The time points and the trajectories of shape
+                (N, t, vars)
+        """
+        sim = self.simulator_obj
+        inputs = np.atleast_2d(np.asarray(inputs, dtype=float))
+        n = len(inputs)
+        t0, tf = sim._contset.first(), sim._contset.last()
+        if tstep is None:
+            tsim = np.linspace(t0, tf, num=100 if numpoints is None else numpoints)
+        else:
+            tsim = np.arange(t0, tf, tstep)
+
+        #Piecewise constant inputs, in the same way as pyomo.dae.Simulator
+        siminputvars = {}
+        switchpts = []
+        if varying_inputs is not None:
+            for alg in sim._algvars:
+                if alg._base in varying_inputs:
+                    switchpts += varying_inputs[alg._base].keys()
+                    siminputvars[alg._base] = alg
+                else:
+                    raise DAE_Error('Algebraic variable {} has no varying input values'.format(alg._base.name))
+            switchpts = sorted(set(switchpts))
+            tsim = np.union1d(tsim, switchpts)
+        elif len(sim._algvars) != 0:
+            raise DAE_Error('Batch simulation requires varying inputs for all algebraic variables')
+        sim._siminputvars = siminputvars
+        sim._simalgvars = []
+
+        initcon = []
+        for v in sim._diffvars:
+            for idx, i in enumerate(v._args):
+                if type(i) is IndexTemplate:
+                    break
+            vidx = tuple(v._args[0:idx]) + (t0,) + tuple(v._args[idx + 1:])
+            initcon.append(value(v._base[vidx]))
+
+        leaves = {id(p): inputs[:, j] for j, p in enumerate(self.params)}
+        evaluator = _BatchEvaluator(leaves)
+        states = [sim._templatemap[v] if v in sim._templatemap else None for v in sim._diffvars]
+        rhs_list = [sim._rhsdict[d] for d in sim._derivlist]
+
+        def rhs(t, y):
+            x = y.reshape(n, self.n_states)
+            sim._cstemplate.set_value(t)
+            for k, param in enumerate(states):
+                if param is not None:
+                    leaves[id(param)] = x[:, k]
+            dxdt = np.empty((n, self.n_states))
+            for k, expr in enumerate(rhs_list):
+                dxdt[:, k] = evaluator.evaluate(expr)
+            return dxdt.ravel()
+
+        profile = np.empty((n, len(tsim), self.n_states))
+        profile[:, 0, :] = initcon
+        y = np.tile(initcon, n).astype(float)
+        bounds = [t for t in switchpts if t0 < t < tsim[-1]]
+        segments = [tsim[0]] + bounds + [tsim[-1]]
+        for start, end in zip(segments[:-1], segments[1:]):
+            for v, alg in siminputvars.items():
+                if start in varying_inputs[v]:
+                    sim._templatemap[alg].set_value(varying_inputs[v][start])
+            mask = (tsim > start) & (tsim <= end)
+            result = solve_ivp(rhs, (start, end), y, t_eval=tsim[mask], **self.options)
+            if not result.success:
+                raise DAE_Error('Batch integration failed: ' + result.message)
+            profile[:, mask, :] = result.y.T.reshape(-1, n, self.n_states).transpose(1, 0, 2)
+            y = result.y[:, -1]
+        return tsim, profile
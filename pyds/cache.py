@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from os.path import exists
+import hashlib
+import pickle
+import atexit
+
+import numpy as np
+
+class LRUCache:
+    """Dict-like cache which evicts the least recently used entries beyond maxsize.
+
+    Args:
+        maxsize (int): Maximum number of entries, None for an unbounded cache.
+    """
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while self.maxsize is not None and len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def get(self, key, default=None):
+        if key in self.data:
+            return self[key]
+        return default
+
+    def keys(self):
+        return self.data.keys()
+
+    def items(self):
+        return self.data.items()
+
+    def clear(self):
+        self.data.clear()
+
+
+class ResultCache(LRUCache):
+    """Cache of g results per design point and parameter sample set.
+
+    Args:
+        maxsize (int): Maximum number of design points, None for an unbounded cache.
+        decimals (int): Design point coordinates are rounded to this number of decimals.
+        filename (str): If given, the cache is loaded from this file and saved to it on exit.
+        fingerprint (str): Identifies the model and settings of the results. Results stored in 
+            the file under a different fingerprint are not loaded.
+    """
+    def __init__(self, maxsize=None, decimals=8, filename=None, fingerprint=None):
+        super().__init__(maxsize)
+        self.decimals = decimals
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        if filename is not None:
+            if exists(filename):
+                self.load()
+            atexit.register(self.save)
+
+    def key(self, d_point, p_hash):
+        return (tuple(np.round(np.asarray(d_point, dtype=float), self.decimals).tolist()), p_hash)
+
+    @staticmethod
+    def hash_samples(p):
+        p = np.ascontiguousarray(p, dtype=float)
+        return hashlib.sha1(str(p.shape).encode() + p.tobytes()).hexdigest()
+
+    def evaluate(self, g, d, p):
+        """Evaluate g(d, p) for the design points without a cached result only.
+
+        Args:
+            g (callable): Function which returns a g_list for a 2d array of design points.
+            d (2d array): Design points
+            p (2d array): Parameter samples
+        """
+        d = np.asarray(d)
+        p_hash = self.hash_samples(p)
+        keys = [self.key(d_point, p_hash) for d_point in d]
+        results = {i: self[k] for i, k in enumerate(keys) if k in self}
+        missing = [i for i in range(len(keys)) if i not in results]
+        self.hits += len(results)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            for i, g_mat in zip(missing, g(d[missing], p)):
+                results[i] = g_mat
+                self[keys[i]] = g_mat.copy()
+        return [results[i].copy() for i in range(len(keys))]
+
+    def load(self):
+        with open(self.filename, 'rb') as f:
+            data = pickle.load(f)
+        if not isinstance(data, dict) or data.get('fingerprint') != self.fingerprint:
+            return
+        for key, g_mat in data['items']:
+            self[key] = g_mat
+
+    def save(self):
+        with open(self.filename, 'wb') as f:
+            pickle.dump({'fingerprint': self.fingerprint, 'items': list(self.items())}, f)
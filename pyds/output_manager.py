@@ -1,35 +1,276 @@
 import pickle
-from os import remove
-from os.path import exists, join
+from os import remove, makedirs, getpid
+from multiprocessing.util import Finalize
+from os.path import exists, join, splitext
+from shutil import rmtree
+from threading import Thread
+from queue import Queue
+import json
 import atexit
 
+import numpy as np
+
+from pyds.profiling import profiler
+
 class OutputManager:
-    def __init__(self, folder):
-        self.output_filename = 'pyds_output'
-        self.output_path_fnx = join(folder, self.output_filename + '.pkl')
-        if exists(self.output_path_fnx):
-            remove(self.output_path_fnx)
-        
+    def __init__(self, folder, filename='pyds_output', format='pickle', chunk_size=100, async_queue_size=None, 
+            design_stage=None):
+        self.output_filename = filename
+        if format == 'pickle':
+            self.output_path_fnx = join(folder, self.output_filename + '.pkl')
+            self.writer = PickleWriter(self.output_path_fnx, join(folder, self.output_filename + '.idx'), design_stage)
+        elif format == 'chunked':
+            self.output_path_fnx = join(folder, self.output_filename + '.chunks')
+            self.writer = ChunkedWriter(self.output_path_fnx, chunk_size)
+        else:
+            raise ValueError('Unknown output format: ' + str(format))
+        if async_queue_size is not None:
+            self.writer = AsyncWriter(self.writer, async_queue_size)
+        atexit.register(self.flush)
+
         self.clear_buffer()
-        
+
     def clear_buffer(self):
         self.data = {
             'input': None,
             'solver': {},
-            'simulator': None
+            'simulator': None,
+            'screening': None
         }
-        
+
     def add_solver_solution(self, container):
-        self.data['solver'].update(container.copy())
+        #The value labels are written once by the writer, not with every record
+        solution = {}
+        for phase, output in container.items():
+            if output is not None and 'labels' in output:
+                output = output.copy()
+                self.writer.set_labels(phase, output.pop('labels'))
+            solution[phase] = output
+        self.data['solver'].update(solution)
 
     def add_simulator_solution(self, container):
         self.data['simulator'] = container.copy()
 
+    def add_screening(self, residuals):
+        self.data['screening'] = residuals.copy()
+
     def add_input(self, data):
         self.data['input'] = data.copy()
 
     def write_data_to_disk(self):
-        with open(self.output_path_fnx, 'ab+') as f:
-            pickle.dump(self.data, f)
+        with profiler.timer('disk write'):
+            self.writer.write(self.data)
+
+    def flush(self):
+        self.writer.flush()
+
+
+class PickleWriter:
+    """Append one pickled record per write to a single file, which is kept open.
+
+    A sidecar index file gets one row of float64 values per design point in a record: 
+    the record number, byte offset and length of the record, the number of the design point 
+    within the record and its coordinates. The file starts with the row width as int64.
+
+    Args:
+        path (str): Output file
+        index_path (str): Index file
+        design_stage (int): Stage of the input which holds the design points
+    """
+    def __init__(self, path, index_path=None, design_stage=None):
+        self.path = path
+        self.index_path = index_path
+        self.labels_path = splitext(path)[0] + '.labels.json'
+        self.labels = {}
+        self.design_stage = design_stage
+        self.file = None
+        self.index_file = None
+        self.n_records = 0
+        for i in [self.path, self.index_path, self.labels_path]:
+            if i is not None and exists(i):
+                remove(i)
+
+    def set_labels(self, phase, labels):
+        """Store the labels of the solver output values of a phase in a sidecar json file"""
+        if self.labels.get(phase) is not labels:
+            self.labels[phase] = labels
+            with open(self.labels_path, 'w') as f:
+                json.dump(self.labels, f)
+
+    def write(self, record):
+        if self.file is None:
+            self.file = open(self.path, 'ab+')
+        offset = self.file.tell()
+        pickle.dump(record, self.file)
+        self.file.flush()
+        if self.index_path is not None:
+            self._write_index(record, offset, self.file.tell() - offset)
+        self.n_records += 1
+
+    def _write_index(self, record, offset, length):
+        inputs = record['input'] or {}
+        if self.design_stage in inputs:
+            points = np.atleast_2d(np.asarray(inputs[self.design_stage], dtype=float))
+        else:
+            points = np.empty((1, 0))
+        if self.index_file is None:
+            self.index_file = open(self.index_path, 'ab+')
+            self.width = 4 + points.shape[1]
+            self.index_file.write(np.int64(self.width).tobytes())
+        rows = np.full((len(points), self.width), np.nan)
+        rows[:, 0:4] = [self.n_records, offset, length, 0]
+        rows[:, 3] = np.arange(len(points))
+        rows[:, 4:4+points.shape[1]] = points[:, 0:self.width-4]
+        self.index_file.write(rows.tobytes())
+        self.index_file.flush()
+
+    def flush(self):
+        for f in [self.file, self.index_file]:
+            if f is not None:
+                f.flush()
+
+
+class AsyncWriter:
+    """Hand records to a writer running in a background thread. 
+
+    Writes block when the queue is full, so the writer applies backpressure instead of 
+    buffering without bound. Errors of the writer thread are raised on the next write or flush.
+    A process forked from the owner starts its own thread and flushes it on a normal exit, 
+    since atexit does not run in multiprocessing children.
+
+    Args:
+        writer (PickleWriter | ChunkedWriter): The writer to run in the background.
+        maxsize (int): Maximum number of queued records.
+    """
+    def __init__(self, writer, maxsize):
+        self.writer = writer
+        self.maxsize = maxsize
+        self.error = None
+        self._start()
+
+    def _start(self):
+        self.pid = getpid()
+        self.queue = Queue(self.maxsize)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _check_process(self):
+        #The thread and queue of the parent are not usable after a fork
+        if self.pid != getpid():
+            self._start()
+            Finalize(None, self.flush, exitpriority=10)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if self.error is not None:
+                    pass
+                elif isinstance(record, tuple):
+                    self.writer.set_labels(*record[1:])
+                else:
+                    self.writer.write(record)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, record):
+        self._check_process()
+        self._raise_error()
+        self.queue.put(record)
+
+    def set_labels(self, phase, labels):
+        #Applied by the writer thread in order with the records
+        self._check_process()
+        self.queue.put(('labels', phase, labels))
+
+    def flush(self):
+        """Wait until all queued records are written, then flush the writer"""
+        self._check_process()
+        self.queue.join()
+        self._raise_error()
+        self.writer.flush()
+
+
+class ChunkedWriter:
+    """Columnar output store. Records are buffered, flattened into fields of numpy arrays and
+    flushed in chunks. Every chunk is a folder with one .npy file per field, which contains the
+    values of all records concatenated along the first axis, and a .offsets.npy file with the
+    start of each record. The field names and value labels are stored once in schema.json.
+
+    Args:
+        path (str): Output folder
+        chunk_size (int): Number of records per chunk
+    """
+    def __init__(self, path, chunk_size=100):
+        self.path = path
+        self.chunk_size = chunk_size
+        if exists(self.path):
+            rmtree(self.path)
+        makedirs(self.path)
+        self.buffer = []
+        self.n_chunks = 0
+        self.schema = {'labels': {}, 'var_names': None}
+
+    def set_labels(self, phase, labels):
+        self.schema['labels'][phase] = labels
+
+    def write(self, record):
+        self.buffer.append(self._flatten(record))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        folder = join(self.path, 'chunk_{:05d}'.format(self.n_chunks))
+        makedirs(folder)
+        names = sorted(set(name for fields in self.buffer for name in fields))
+        for name in names:
+            arrays = [fields.get(name) for fields in self.buffer]
+            present = [a for a in arrays if a is not None]
+            empty = np.empty((0,) + present[0].shape[1:], dtype=present[0].dtype)
+            arrays = [empty if a is None else a for a in arrays]
+            offsets = np.cumsum([0] + [len(a) for a in arrays])
+            np.save(join(folder, name + '.npy'), np.concatenate(arrays))
+            np.save(join(folder, name + '.offsets.npy'), offsets)
+        with open(join(folder, 'chunk.json'), 'w') as f:
+            json.dump({'n_records': len(self.buffer), 'fields': names}, f)
+        self.buffer = []
+        self.n_chunks += 1
+        self._write_schema()
+
+    def _write_schema(self):
+        with open(join(self.path, 'schema.json'), 'w') as f:
+            json.dump(self.schema, f)
+
+    def _flatten(self, record):
+        fields = {}
+        for stage, values in (record['input'] or {}).items():
+            fields['input.{}'.format(stage)] = np.atleast_2d(np.asarray(values, dtype=float))
+
+        for phase, container in record['solver'].items():
+            if container is None:
+                continue
+            prefix = 'solver.{}.'.format(phase)
+            for key in ['objective', 'user time', 'infeasible']:
+                value = container.get(key)
+                fields[prefix + key.replace(' ', '_')] = np.array([np.nan if value is None else value], dtype=float)
+            fields[prefix + 'data'] = np.asarray(container['data'], dtype=float)
 
+        if record.get('screening') is not None:
+            fields['screening'] = np.asarray(record['screening'], dtype=float)
 
+        simulator = record['simulator']
+        if simulator:
+            self.schema['var_names'] = simulator[0]['var_names']
+            fields['simulator.user_time'] = np.array([np.nan if s['user time'] is None else s['user time'] for s in simulator], dtype=float)
+            fields['simulator.tsim'] = np.stack([s['tsim'] for s in simulator])
+            fields['simulator.simsolution'] = np.stack([s['simsolution'] for s in simulator])
+        return fields
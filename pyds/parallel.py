@@ -0,0 +1,115 @@
+from types import SimpleNamespace
+from multiprocessing.util import Finalize
+import multiprocessing
+import atexit
+import copy
+import os
+
+import numpy as np
+
+#Managers living in the current (worker) process, keyed by the token of their parent manager
+_managers = {}
+#Simulator of the current simulation worker process
+_simulator = None
+
+def worker_config(config, keep_cache=False):
+    """Return a copy of config for a manager running inside a worker process.
+
+    Worker managers evaluate serially and write to their own output file. The g results of a 
+    ManagerPool are cached by the parent manager. Workers of other pools, like the DEUS mppool, 
+    are the only managers which evaluate g, so with keep_cache they keep a cache of their own in 
+    memory. It is not saved to the cache file, which is shared by all workers.
+    """
+    config = copy.deepcopy(config)
+    problem = config['problem']
+    problem['n workers'] = 1
+    if keep_cache:
+        problem['g cache file'] = None
+    else:
+        problem['g cache size'] = 0
+    config['simulator']['n workers'] = 1 #Workers cannot start pools of their own
+    problem['output filename'] = '{}_{}'.format(problem.get('output filename', 'pyds_output'), os.getpid())
+    return config
+
+def get_worker_manager(manager_cls, config, token, keep_cache=False):
+    """Get the manager for token in this process, constructing it on first use.
+
+    atexit does not run in worker processes, so the output of the manager is flushed by a 
+    multiprocessing finalizer when the worker exits normally.
+    """
+    if token not in _managers:
+        manager = manager_cls(worker_config(config, keep_cache))
+        Finalize(None, manager.output_manager.flush, exitpriority=10)
+        _managers[token] = manager
+    return _managers[token]
+
+def n_workers(n):
+    """Number of worker processes, -1 uses all cores"""
+    if n is None or n == -1:
+        return os.cpu_count()
+    return n
+
+def _init_worker(manager_cls, config, token):
+    get_worker_manager(manager_cls, config, token)
+
+def _evaluate(token, d, p):
+    return _managers[token].g(d, p)
+
+class ManagerPool:
+    """Pool of worker processes which each hold a pre-built manager.
+
+    Args:
+        manager (Manager): The manager to replicate in the workers. The config and 
+            stage rules must be picklable.
+        n_workers (int): Number of worker processes.
+    """
+    def __init__(self, manager, n_workers):
+        self.token = manager.token
+        self.pool = multiprocessing.Pool(n_workers, initializer=_init_worker, 
+            initargs=(type(manager), manager.config, manager.token))
+        atexit.register(self.close)
+
+    def g(self, d, p):
+        """Evaluate the design points d one by one in parallel and gather g_list in order."""
+        results = self.pool.starmap(_evaluate, [(self.token, d[i:i+1], p) for i in range(np.shape(d)[0])])
+        return [g_mat for result in results for g_mat in result]
+
+    def close(self):
+        #Workers which exit normally flush their output, terminated workers would lose it
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def _init_simulator(parent, config):
+    from pyds.simulator import Simulator
+    global _simulator
+    config = dict(config, **{'n workers': 1, 'save output': False})
+    _simulator = Simulator(parent, config)
+
+def _simulate(input):
+    _simulator._simulate(np.array([input]))
+    return _simulator.get_sim_result()
+
+class SimulatorPool:
+    """Pool of worker processes which each hold their own flattened model and pyomo Simulator.
+
+    Args:
+        simulator (Simulator): The simulator to replicate in the workers.
+        n_workers (int): Number of worker processes.
+    """
+    def __init__(self, simulator, n_workers):
+        parent = SimpleNamespace(stage_rules=simulator.stage_rules, 
+            model_transformation=simulator.model_transformation, input_map=simulator.parent.input_map)
+        self.pool = multiprocessing.Pool(n_workers, initializer=_init_simulator, 
+            initargs=(parent, simulator.config))
+        atexit.register(self.close)
+
+    def simulate(self, inputs):
+        """Simulate every row of inputs and gather the (tsim, simsolution) trajectories in order"""
+        return self.pool.map(_simulate, list(inputs))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
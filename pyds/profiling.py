@@ -0,0 +1,101 @@
+from collections import defaultdict
+from time import perf_counter
+import cProfile
+import pstats
+import atexit
+import io
+
+class _Timer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add_time(self.name, perf_counter() - self.t0)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class Profiler:
+    """Wall clock timers per phase and event counters of a run.
+
+    Timers and counters are no-ops until the profiler is enabled. A single instance is shared by
+    the Manager, Solver and Simulator of a process, worker processes keep their own.
+
+    Args:
+        enabled (bool): Record timings and counts.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.cprofile = None
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def timer(self, name):
+        """Context manager which adds the elapsed time of its block to the phase name"""
+        if not self.enabled:
+            return _NullTimer()
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        self.times[name] += seconds
+        self.calls[name] += 1
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def summary(self):
+        """Return the timings as dict of phase: (calls, total seconds) and the counters"""
+        return {
+            'times': {k: (self.calls[k], self.times[k]) for k in self.times},
+            'counters': dict(self.counters)
+        }
+
+    def report(self):
+        """Format the timings and counters as a table"""
+        lines = ['{:<24}{:>10}{:>14}{:>14}'.format('phase', 'calls', 'total [s]', 'mean [ms]')]
+        for name in sorted(self.times, key=self.times.get, reverse=True):
+            total, calls = self.times[name], self.calls[name]
+            lines.append('{:<24}{:>10}{:>14.3f}{:>14.3f}'.format(name, calls, total, 1e3*total/calls))
+        if len(self.counters):
+            lines.append('')
+            lines.append('{:<24}{:>10}'.format('counter', 'count'))
+            for name in sorted(self.counters):
+                lines.append('{:<24}{:>10}'.format(name, self.counters[name]))
+        if self.cprofile is not None:
+            stream = io.StringIO()
+            pstats.Stats(self.cprofile, stream=stream).sort_stats('cumulative').print_stats(20)
+            lines.append('')
+            lines.append(stream.getvalue())
+        return '\n'.join(lines)
+
+    def print_report(self):
+        if self.enabled and (len(self.times) or len(self.counters)):
+            print(self.report())
+
+    def enable_cprofile(self, filename=None):
+        """Collect a cProfile of the calls of Manager.g. The stats are added to the report and
+        written to filename on exit, if given."""
+        if self.cprofile is None:
+            self.cprofile = cProfile.Profile()
+            if filename is not None:
+                atexit.register(self.cprofile.dump_stats, filename)
+
+
+profiler = Profiler()
+atexit.register(profiler.print_report)
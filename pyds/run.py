@@ -2,13 +2,27 @@ from pyds.solver import Solver
 from pyds.output_manager import OutputManager
 import pyds.utils as utils
 from pyomo.opt import SolverFactory
+from pyomo.core.base import Var
 from pyds.simulator import Simulator
+from pyds.cache import ResultCache
+from pyds.profiling import profiler
+import pyds.parallel as parallel
+from collections import OrderedDict
 import numpy as np
+import uuid
+import hashlib
+import inspect
+import time
 import os
 
 
 class Manager():
+    #Stage of the input which holds the design points
+    design_stage = None
+
     def __init__(self, config):
+        self.config = config
+        self.token = uuid.uuid4().hex
         problem = config['problem']
 
         self.stage_rules = problem['stage rules']
@@ -20,80 +34,511 @@ class Manager():
             self.output_folder = os.getcwd()
         else:
             self.output_folder = problem['output folder']
-        self.output_manager = OutputManager(self.output_folder)
+        problem.setdefault('output filename', 'pyds_output')
+        problem.setdefault('output format', 'pickle')
+        problem.setdefault('output chunk size', 100)
+        problem.setdefault('async output', False)
+        problem.setdefault('output queue size', 16)
+        self.output_manager = OutputManager(self.output_folder, problem['output filename'], 
+            problem['output format'], problem['output chunk size'], 
+            problem['output queue size'] if problem['async output'] else None, self.design_stage)
         self.solver = Solver(self, config['solver'])
         self.simulator = Simulator(self, config['simulator'])
         self.model = None
+        self.flush_output = False
+
+        #Pool of previously built EF models, keyed by branching factors
+        problem.setdefault('model pool size', 1)
+        problem.setdefault('model capacity', None)
+        self.model_pool_size = problem['model pool size']
+        self.model_capacity = problem['model capacity']
+        self.model_pool = OrderedDict()
+        #Total seconds spent building and growing models
+        self.construction_time = 0.0
+        #Grow the EF in capacity mode by cloning the first substage of every stage into the new 
+        #substages, instead of rebuilding it. A clone costs about twice the construction and 
+        #transformation of a substage, so the EF is only grown by at most its own size.
+        problem.setdefault('clone scenarios', False)
+        self.clone_scenarios = problem['clone scenarios']
+
+        #Parallel evaluation of design points
+        problem.setdefault('n workers', 1)
+        self.n_workers = parallel.n_workers(problem['n workers'])
+        self.pool = None
+
+        #Memoized g results per design point, created by _init_g_cache of the subclasses. 
+        #A size of 0 disables the cache, None makes it unbounded.
+        problem.setdefault('g cache size', 0)
+        problem.setdefault('g cache decimals', 8)
+        problem.setdefault('g cache file', None)
+        self.g_cache = None
+
+        #Timers and counters per phase, reported on exit. cProfile is limited to the calls of g.
+        problem.setdefault('profiling', False)
+        problem.setdefault('cprofile', False)
+        problem.setdefault('profile file', None)
+        if problem['profiling'] or problem['cprofile']:
+            profiler.enabled = True
+        if problem['cprofile']:
+            filename = problem['profile file']
+            if filename is not None:
+                filename = os.path.join(self.output_folder, filename)
+            profiler.enable_cprofile(filename)
 
     def g(self, d, p):
+        cprofile = profiler.cprofile
+        if cprofile is not None:
+            cprofile.enable()
+        try:
+            with profiler.timer('g'):
+                profiler.count('design points', np.shape(d)[0])
+                if self.g_cache is None:
+                    g_list = self._evaluate(d, p)
+                else:
+                    hits = self.g_cache.hits
+                    g_list = self.g_cache.evaluate(self._evaluate, d, p)
+                    profiler.count('g cache hits', self.g_cache.hits - hits)
+            if self.flush_output:
+                self.output_manager.flush()
+            return g_list
+        finally:
+            if cprofile is not None:
+                cprofile.disable()
+
+    def _evaluate(self, d, p):
         self.output = {}
         pass
 
+    def _independent_points(self):
+        """Whether the g of a design point does not depend on the other points of a call"""
+        return False
+
+    def _init_g_cache(self):
+        problem = self.config['problem']
+        if problem['g cache size'] == 0:
+            return
+        if not self._independent_points():
+            raise ValueError('The g cache requires design points which are solved independently, '
+                'the g of a point in a batched EF depends on the other points')
+        filename = problem['g cache file']
+        if filename is not None:
+            filename = os.path.join(self.output_folder, filename)
+        self.g_cache = ResultCache(problem['g cache size'], problem['g cache decimals'], filename, 
+            self._fingerprint())
+
+    def _fingerprint(self):
+        """Hash of the model definition and the solver settings, which identifies g results"""
+        parts = [type(self).__name__, str(self.design_stage), repr(self.input_map), 
+            repr(sorted((k, repr(v)) for k, v in self.config['solver'].items()))]
+        for f in self.stage_rules + [self.model_transformation]:
+            try:
+                parts.append(inspect.getsource(f))
+            except (OSError, TypeError):
+                parts.append(getattr(f, '__qualname__', repr(f)))
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+    def _set_model(self, BFs):
+        """Make an EF with branching factors BFs the active model, avoiding reconstruction.
+
+        In capacity mode a single EF is built at the largest BFs seen so far (or the configured
+        capacity) and resized in place. Otherwise, models are kept in a pool keyed by BFs.
+        """
+        BFs = [int(i) for i in BFs]
+        if self.model is not None and list(self.model.BFs) == BFs:
+            return
+
+        if self.model_capacity is not None:
+            capacity = BFs if self.model_capacity is True else list(self.model_capacity)
+            if self.model is not None:
+                capacity = np.maximum(capacity, self.model.capacity_BFs)
+            capacity = list(np.maximum(capacity, BFs))
+            if self.model is None or list(self.model.capacity_BFs) != capacity:
+                n_scenarios = np.prod(self.model.capacity_BFs) if self.model is not None else 0
+                if self.clone_scenarios and 0 < np.prod(capacity) - n_scenarios <= n_scenarios:
+                    t0 = time.perf_counter()
+                    with profiler.timer('model growth'):
+                        utils.grow_EF(self.model, capacity)
+                    self.construction_time += time.perf_counter() - t0
+                else:
+                    self._build_model(capacity)
+            utils.resize_EF(self.model, BFs)
+            profiler.count('model resizes')
+            return
+
+        key = tuple(BFs)
+        if key in self.model_pool:
+            self.model_pool.move_to_end(key)
+            self.model = self.model_pool[key]
+            profiler.count('model pool hits')
+            return
+        self._build_model(BFs)
+        self.model_pool[key] = self.model
+        while len(self.model_pool) > self.model_pool_size:
+            self.model_pool.popitem(last=False)
+
     def _build_model(self, BFs):
-        self.model = utils.create_EF(self.stage_rules, BFs)
-        self.model_transformation(self.model) 
+        t0 = time.perf_counter()
+        with profiler.timer('model build'):
+            relax = self.solver.use_relaxation and self.solver.relax_on_construction
+            self.model = utils.create_EF(self.stage_rules, BFs, relax_integer_vars=relax, 
+                model_transformation=self.model_transformation)
+        self.construction_time += time.perf_counter() - t0
+        profiler.count('model builds')
+
+    def _load_input(self, input):
+        #The simulator loads its own model, which is timed as part of the simulation
+        with profiler.timer('load input'):
+            utils.load_input(self.model, self.input_map, input)
+
+    def _initialize(self, input):
+        """Initialize the EF from a cached nearby solution, or by simulation otherwise"""
+        if self.solver.load_warmstart(input):
+            self.simulator.output = []
+            self.simulator.trajectories = None
+            profiler.count('warm starts')
+        else:
+            self.simulator.simulate_all_scenarios(self.model, input)
+
+    def _parallel_g(self, d, p):
+        if self.pool is None:
+            self.pool = parallel.ManagerPool(self, self.n_workers)
+        return self.pool.g(d, p)
+
+    def __getstate__(self):
+        #Only the config is sent to other processes, the models are rebuilt there
+        return {'config': self.config, 'token': self.token}
+
+    def __setstate__(self, state):
+        #Pools of other packages, like the DEUS mppool, may terminate their workers, so the output 
+        #of these managers is flushed after every call of g. They keep their own g cache in memory.
+        manager = parallel.get_worker_manager(type(self), state['config'], state['token'], keep_cache=True)
+        manager.flush_output = True
+        self.__dict__ = manager.__dict__
 
     def scenario(self, idx):
         return utils.get_scenario(self.model, idx)                           
 
     def write_output_to_disk(self):
-        self.output_manager.write_output_to_disk()
+        self.output_manager.flush()
     
 
 class TwoStageManager(Manager):
+    design_stage = 0
+
     def __init__(self, config):
         super().__init__(config)
+        #Screen out scenarios which violate a big-M constraint at the simulated trajectories, only 
+        #the remaining scenarios are solved. The EF is resized in place for the smaller solves.
+        config['problem'].setdefault('screening', False)
+        config['problem'].setdefault('screening margin', 1e-2)
+        self.screening = config['problem']['screening']
+        self.screening_margin = config['problem']['screening margin']
+        if self.screening and self.model_capacity is None:
+            self.model_capacity = True
+        self.no_screened = 0
+        self._init_g_cache()
+
+    def _independent_points(self):
+        return True
+
+    def _evaluate(self, d, p):
+        if self.n_workers > 1 and np.shape(d)[0] > 1:
+            return self._parallel_g(d, p)
 
-    def g(self, d, p):
         #Rebuild the model and simulator if the BFs have changed
         n_p = np.shape(p)[0]
-        if self.model is None or self.model.BFs[1] != n_p:
-            self._build_model([1, n_p])
+        self._set_model([1, n_p])
 
         g_list = []
         #Iterate the design points d
         for i, d_point in enumerate(d):
             g_mat = np.empty((n_p, 1))
             input = {0: np.array([d_point]), 1: p}
-            utils.load_input(self.model, self.input_map, input)
+            self._load_input(input)
             self.output_manager.clear_buffer()
             self.output_manager.add_input(input)
-            self.simulator.simulate_all_scenarios(self.model, input)  
+            self._initialize(input)
             self.output_manager.add_simulator_solution(self.simulator.output)
-            self.solver.solve()
-            self.output_manager.add_solver_solution(self.solver.output)
-            g_mat[:, 0] = -self.solver._get_indicator_var_values() #DEUS uses g>=0 inequality constraints, contrary to convention
+            if self.screening:
+                g_mat[:, 0] = self._screen(input)
+            else:
+                self.solver.solve(input)
+                self.output_manager.add_solver_solution(self.solver.output)
+                g_mat[:, 0] = -self.solver._get_indicator_var_values() #DEUS uses g>=0 inequality constraints, contrary to convention
             g_list.append(g_mat)
             self.output_manager.write_data_to_disk()
 
         return g_list
 
+    def _screen(self, input):
+        """Screen the scenarios of an EF initialized by simulation. Scenarios of which a big-M 
+        constraint is violated by more than the margin are set infeasible, the other scenarios 
+        are solved in a smaller EF, initialized with their simulated trajectories.
+
+        The infeasible scenarios are judged at the initial control values, so a scenario which 
+        the solver could make feasible by changing the controls can be screened out. The reported
+        g is still achieved by the controls of the smaller EF, since infeasible scenarios 
+        do not constrain them.
+
+        Returns:
+            1d array: g of the scenarios
+        """
+        residuals = utils.get_bigM_residuals(self.model)
+        self.output_manager.add_screening(residuals)
+        g = np.full(len(residuals), -1.0)
+        remaining = np.flatnonzero(~(residuals > self.screening_margin))
+        self.no_screened += len(residuals) - len(remaining)
+        profiler.count('screened scenarios', len(residuals) - len(remaining))
+        if len(remaining) == 0:
+            return g
+
+        BFs = list(self.model.BFs)
+        input = {0: input[0], 1: np.asarray(input[1])[remaining]}
+        self._set_model([1, len(remaining)])
+        self._load_input(input)
+        if self.simulator.trajectories is not None:
+            self.simulator.export_trajectories(self.model, remaining)
+        else:
+            self._initialize(input)
+        self.solver.solve(input)
+        self.output_manager.add_solver_solution(self.solver.output)
+        g[remaining] = -self.solver._get_indicator_var_values()
+        self._set_model(BFs)
+        return g
+
 class ThreeStageManager(Manager):
+    design_stage = 1
+
     def __init__(self, config):
         super().__init__(config)
-    def g(self, d, p):
+        #Solve every design point subtree as an independent EF with BFs [1, 1, n_p]. 
+        #The first-stage variables are then optimised per design point.
+        config['problem'].setdefault('decompose', False)
+        self.decompose = config['problem']['decompose']
+        #Number of design points per EF: None for all points of a call, an int, or 'auto' to 
+        #tune it online for the highest throughput. Use with 'model capacity' to avoid rebuilds, 
+        #which 'auto' turns on since the tuner times the resizes of the model.
+        config['problem'].setdefault('batch size', None)
+        self.batch_size = config['problem']['batch size']
+        self.batch_tuner = BatchSizeTuner() if self.batch_size == 'auto' else None
+        if self.batch_tuner is not None and self.model_capacity is None:
+            self.model_capacity = True
+        self._init_g_cache()
+
+    def _independent_points(self):
+        return self.decompose
+
+    def _evaluate(self, d, p):
+        n_d = np.shape(d)[0]
+        if self.decompose and n_d > 1 and self.n_workers > 1:
+            return self._parallel_g(d, p)
+
+        if self.batch_tuner is not None and not self.decompose:
+            self.batch_tuner.set_maximum(n_d)
+        g_list = []
+        start = 0
+        while start < n_d:
+            size = self._get_batch_size(n_d - start)
+            g_list.extend(self._solve_EF(d[start:start+size], p))
+            start += size
+        return g_list
+
+    def _get_batch_size(self, n_left):
+        if self.decompose:
+            return 1
+        if self.batch_tuner is not None:
+            return min(self.batch_tuner.size, n_left)
+        if self.batch_size is None:
+            return n_left
+        return min(int(self.batch_size), n_left)
+
+    def _solve_EF(self, d, p):
         #Rebuild the model and simulator if the BFs have changed
         n_d, d_dim = np.shape(d)
         n_p, p_dim = np.shape(p)
-        BFs = np.array([1, n_d, n_p])
-
-        if self.model is None or np.any(self.model.BFs != BFs):
-            self._build_model(BFs)
+        #The tuner measures the resizes of the model, but not its one-off construction
+        t0 = time.perf_counter()
+        construction_time = self.construction_time
+        self._set_model([1, n_d, n_p])
 
         g_list = []
         #Iterate the design points d
         input = {1: d, 2: np.tile(p, (n_d*n_p,1))}
-        utils.load_input(self.model, self.input_map, input)
+        self._load_input(input)
         self.output_manager.clear_buffer()
         self.output_manager.add_input(input)
-        self.simulator.simulate_all_scenarios(self.model, input)
+        self._initialize(input)
         self.output_manager.add_simulator_solution(self.simulator.output)
-        self.solver.solve()
+        self.solver.solve(input)
         self.output_manager.add_solver_solution(self.solver.output)
         for i, d_point in enumerate(d):
             g_mat = np.empty((n_p, 1))
             g_mat[:, 0] = -self.solver._get_indicator_var_values()[n_p*i:n_p*(i+1)] #DEUS uses g>=0 inequality constraints, contrary to convention
             g_list.append(g_mat)
         self.output_manager.write_data_to_disk()
+        if self.batch_tuner is not None:
+            self.batch_tuner.update(n_d, n_d*n_p, 
+                time.perf_counter() - t0 - (self.construction_time - construction_time))
         return g_list
 
+
+class BatchSizeTuner:
+    """Online search for the batch size with the highest throughput in scenarios per second.
+
+    The throughput of every batch size is smoothed over its measurements. The next batch size 
+    is an unmeasured neighbour of the best one: its double or half first, then the sizes halfway
+    in between. Once the best batch size and all its neighbours are measured at least twice, the 
+    search stops and the best batch size is used from then on.
+
+    Args:
+        initial (int): First batch size
+        maximum (int): Largest batch size, None for no limit
+        smoothing (float): Weight of the previous throughput of a batch size in [0, 1)
+    """
+    def __init__(self, initial=1, maximum=None, smoothing=0.5):
+        self.size = initial
+        self.maximum = maximum
+        self.smoothing = smoothing
+        self.throughput = {}
+        self.samples = {}
+        self.settled = False
+
+    def set_maximum(self, maximum):
+        """Limit the batch sizes, e.g. to the number of design points of a call. A new limit 
+        resumes the search."""
+        if maximum != self.maximum:
+            self.maximum = maximum
+            self.settled = False
+            if self.throughput:
+                self._propose()
+            elif self.maximum is not None:
+                self.size = min(self.size, self.maximum)
+
+    def update(self, size, n_scenarios, seconds):
+        if self.settled:
+            return
+        throughput = n_scenarios/max(seconds, 1e-12)
+        if size in self.throughput:
+            throughput = self.smoothing*self.throughput[size] + (1-self.smoothing)*throughput
+        self.throughput[size] = throughput
+        self.samples[size] = self.samples.get(size, 0) + 1
+        self._propose()
+
+    def _propose(self):
+        sizes = [size for size in self.throughput if self.maximum is None or size <= self.maximum]
+        if not sizes:
+            self.size = self.maximum
+            return
+        best = max(sizes, key=self.throughput.get)
+        self.size = best
+        candidates = [size for size in [2*best, best//2, (3*best)//2, (3*best)//4]
+            if size >= 1 and (self.maximum is None or size <= self.maximum)]
+        for candidate in candidates:
+            if candidate not in self.throughput:
+                self.size = candidate
+                return
+        #Measure again the sizes with a single sample, which may be an outlier
+        for candidate in [best] + candidates:
+            if self.samples[candidate] < 2:
+                self.size = candidate
+                return
+        self.settled = True
+
+
+class MultiStageManager(Manager):
+    """Manager for a stage tree of any depth. The design points d are the input of the design 
+    stage and the parameter samples p the input of the next stage, all other stages have a 
+    single branch. 
+
+    A call of g either solves an EF with BFs n_d and n_p at these two stages, or one EF with a 
+    single design point per point. In 'auto' batch mode a cost model of the solve time, 
+    solve overhead + scenario cost * n_scenarios**cost exponent, decides between them. Batching 
+    changes the result if the stages above the design stage have free variables, since these are 
+    then optimised for all design points together. 'auto' only batches if there are none.
+    """
+    def __init__(self, config):
+        problem = config['problem']
+        problem.setdefault('design stage', len(problem['stage rules'])-2)
+        self.design_stage = problem['design stage']
+        super().__init__(config)
+        problem.setdefault('batch mode', 'auto')
+        problem.setdefault('solve overhead', 1.0)
+        problem.setdefault('scenario cost', 1e-2)
+        problem.setdefault('cost exponent', 1.5)
+        self.batch_mode = problem['batch mode']
+        self.solve_overhead = problem['solve overhead']
+        self.scenario_cost = problem['scenario cost']
+        self.cost_exponent = problem['cost exponent']
+        self._shared_decisions = None
+
+        if self.batch_mode not in ['auto', 'batched', 'per point']:
+            raise ValueError('Unknown batch mode: ' + str(self.batch_mode))
+        if not 0 <= self.design_stage < self.n_stages-1:
+            raise ValueError('The design stage must be followed by a parameter stage')
+        if not set(self.input_map.keys()) <= {self.design_stage, self.design_stage+1}:
+            raise ValueError('Inputs are only supported at the design stage and the stage after it')
+        self._init_g_cache()
+
+    def _independent_points(self):
+        return self.design_stage == 0 or self.batch_mode == 'per point'
+
+    def _evaluate(self, d, p):
+        d = np.asarray(d)
+        n_d, n_p = np.shape(d)[0], np.shape(p)[0]
+        if self._use_batch(n_d, n_p):
+            return self._solve_EF(d, p)
+        if self.n_workers > 1 and n_d > 1:
+            return self._parallel_g(d, p)
+
+        g_list = []
+        for i in range(n_d):
+            g_list.extend(self._solve_EF(d[i:i+1], p))
+        return g_list
+
+    def _get_BFs(self, n_d, n_p):
+        BFs = [1]*self.n_stages
+        BFs[self.design_stage] = n_d
+        BFs[self.design_stage+1] = n_p
+        return BFs
+
+    def _use_batch(self, n_d, n_p):
+        #The root stage has a single branch, so design points at stage 0 cannot be batched
+        if n_d == 1 or self.design_stage == 0 or self.batch_mode == 'per point':
+            return n_d == 1
+        if self.batch_mode == 'batched':
+            return True
+        if self._has_shared_decisions(n_p):
+            return False
+        return self._solve_cost(n_d*n_p) < n_d*self._solve_cost(n_p)
+
+    def _solve_cost(self, n_scenarios):
+        return self.solve_overhead + self.scenario_cost*n_scenarios**self.cost_exponent
+
+    def _has_shared_decisions(self, n_p):
+        """Check whether the stages above the design stage have unfixed variables"""
+        if self._shared_decisions is None:
+            self._set_model(self._get_BFs(1, n_p))
+            self._shared_decisions = False
+            for stage in range(self.design_stage):
+                block = utils.get_scenario(self.model, (0,)*(stage+1))
+                for var in block.component_data_objects(Var, active=True, descend_into=False):
+                    if not var.fixed:
+                        self._shared_decisions = True
+        return self._shared_decisions
+
+    def _solve_EF(self, d, p):
+        n_d, n_p = np.shape(d)[0], np.shape(p)[0]
+        self._set_model(self._get_BFs(n_d, n_p))
+
+        input = {self.design_stage: d, self.design_stage+1: np.tile(p, (n_d, 1))}
+        self._load_input(input)
+        self.output_manager.clear_buffer()
+        self.output_manager.add_input(input)
+        self._initialize(input)
+        self.output_manager.add_simulator_solution(self.simulator.output)
+        self.solver.solve(input)
+        self.output_manager.add_solver_solution(self.solver.output)
+        self.output_manager.write_data_to_disk()
+        #The final scenarios are ordered by design point, DEUS uses g>=0 inequality constraints
+        g = -self.solver._get_indicator_var_values().reshape(n_d, n_p, 1)
+        return list(g)
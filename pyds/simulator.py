@@ -1,4 +1,7 @@
 import pyds.utils as utils
+import pyds.parallel as parallel
+from pyds.batch_simulator import BatchSimulator
+from pyds.profiling import profiler
 
 from pyomo.common.collections.component_map import ComponentMap
 from pyomo.core.expr.template_expr import IndexTemplate
@@ -18,11 +21,22 @@ class Simulator:
         self.package = config['package']
         self.save_output = config['save output']
         self.suffix_name = config['suffix name']
-        self.kwargs = config['kwargs']
+        self.kwargs = dict(config['kwargs'])
+        config.setdefault('n workers', 1)
+        self.n_workers = parallel.n_workers(config['n workers'])
+        #Integrate all scenarios as one stacked system, scipy package only
+        config.setdefault('batch', False)
+        config.setdefault('batch options', {})
+        self.batch = config['batch']
+        self.batch_options = config['batch options']
+        self.batch_simulator = None
+        self.config = config
         
+        self.pool = None
         self.model = None
         self.simulator_obj = None
         self.user_time = None
+        self.trajectories = None
         if self.enabled:
             self._build_model()
             self.simulator_obj = PyomoSimulator(self.model, self.package)
@@ -35,22 +49,80 @@ class Simulator:
         #Warning: This method only initializes time-varying variables, not input parameters
         t0 = time.time()
         self.output = []
+        self.trajectories = None
         if not self.enabled:
             return
         model = output_model
         BFs = model.BFs
         n_stages = model.n_stages
-        for s_idx in utils.get_all_idx(BFs):
+        all_idx = list(utils.get_all_idx(BFs))
+        inputs = []
+        for s_idx in all_idx:
             input = []
             for s in self.parent.input_map.keys():
                 input.extend(input_values[s][s_idx[s], :])
-            input = np.array([input])
-            self._simulate(input)
-            self._export_trajectories_to_model(model, s_idx)
-            if self.save_output:
-                self.output.append(self._collect_output().copy())
+            inputs.append(input)
+
+        #Identical input vectors are only simulated once
+        unique_inputs, inverse = np.unique(np.array(inputs, dtype=float), axis=0, return_inverse=True)
+        with profiler.timer('simulate'):
+            solutions = self._simulate_unique(unique_inputs)
+        profiler.count('simulations', len(unique_inputs))
+        with profiler.timer('export trajectories'):
+            for s_idx, i in zip(all_idx, inverse.ravel()):
+                self.simulator_obj._tsim, self.simulator_obj._simsolution = solutions[i]
+                self._export_trajectories_to_model(model, s_idx)
+                if self.save_output:
+                    self.output.append(self._collect_output().copy())
+        #The (tsim, simsolution) of every scenario, to export them again without simulating
+        self.trajectories = [solutions[i] for i in inverse.ravel()]
         self.user_time = time.time()-t0
 
+    def export_trajectories(self, model, scenarios):
+        """Export the trajectories of the last simulated scenarios into model without simulating.
+
+        Args:
+            model (ConcreteModel): The EF, the i-th final scenario gets the trajectory of 
+                scenarios[i].
+            scenarios (list of int): Positions of the scenarios in the last simulation
+        """
+        with profiler.timer('export trajectories'):
+            for s_idx, i in zip(utils.get_all_idx(model.BFs), scenarios):
+                self.simulator_obj._tsim, self.simulator_obj._simsolution = self.trajectories[i]
+                self._export_trajectories_to_model(model, s_idx)
+
+    def _simulate_unique(self, inputs):
+        """Simulate every row of inputs, on the worker pool if enabled.
+
+        Returns:
+            list of tuple: The (tsim, simsolution) trajectories in the order of inputs
+        """
+        if self.batch:
+            return self._simulate_batch(inputs)
+        if self.n_workers > 1 and len(inputs) > 1:
+            if self.simulator_obj._simalgvars is None:
+                #The local simulator has to run once to know which variables to export
+                return self._simulate_unique(inputs[:1]) + self._simulate_unique(inputs[1:])
+            if self.pool is None:
+                self.pool = parallel.SimulatorPool(self, self.n_workers)
+            return self.pool.simulate(inputs)
+
+        solutions = []
+        for input in inputs:
+            self._simulate(np.array([input]))
+            solutions.append(self.get_sim_result())
+        return solutions
+
+    def _simulate_batch(self, inputs):
+        if self.batch_simulator is None:
+            params = utils.bind_input(self.model, self.input_names, 0)[0]
+            self.batch_simulator = BatchSimulator(self.simulator_obj, params, self.batch_options)
+        kwargs = dict(self.kwargs)
+        if self.suffix_name is not None:
+            kwargs['varying_inputs'] = self.model.component(self.suffix_name)
+        tsim, profile = self.batch_simulator.simulate(inputs, **kwargs)
+        return [(tsim, profile[i]) for i in range(len(inputs))]
+
     def _simulate(self, input_values):
         utils.load_input(self.model, {0: self.input_names}, {0: input_values})
         if self.suffix_name is not None:
@@ -61,37 +133,55 @@ class Simulator:
 
     def _export_trajectories_to_model(self, model, scenario_idx=None):        
         #Adapted from pyomo dae.simulator.initialize_model()
+        tvals, handles, positions = self._get_export_map(model, scenario_idx)
+        valinit = interp_columns(tvals, self.simulator_obj._tsim, self.simulator_obj._simsolution)
+        values = valinit.T.ravel()[positions].tolist()
+        for var, value in zip(handles, values):
+            var.set_value(value, skip_validation=True)
+
+    def _get_export_map(self, model, scenario_idx=None):
+        """Map the simulator variables to their targets in the model. Cached on the model.
+
+        Returns:
+            tuple: The time points, the target VarData and for each target the position of its 
+                value in the flattened (variable, time) array of interpolated trajectories.
+        """
+        cache = utils.model_cache(model, 'trajectories')
+        if scenario_idx in cache:
+            return cache[scenario_idx]
+
         def stages_to_update(idx):
             a = np.array(idx)
             should_update_mask = [np.all(a[i+1:]==0) for i in range(len(a))] #empty slice of last i evaluates to True
             stages = [i for i in range(len(a)) if should_update_mask[i]]
             return [tuple(idx[:i+1]) for i in stages]
-            
+
         tvals = list(self.simulator_obj._contset)
+        if scenario_idx is None:
+            blocks = [model]
+        else:
+            blocks = [utils.get_scenario(model, s_idx) for s_idx in stages_to_update(scenario_idx)]
         # Build list of state and algebraic variables
         # that can be initialized
         initvars = self.simulator_obj._diffvars + self.simulator_obj._simalgvars
 
+        handles = []
+        positions = []
         for idx, v in enumerate(initvars):
             for idx2, i in enumerate(v._args):
                     if type(i) is IndexTemplate:
                         break
-            valinit = np.interp(tvals, self.simulator_obj._tsim,
-                                self.simulator_obj._simsolution[:, idx])
+            targets = [b.component(v._base.local_name) for b in blocks]
+            targets = [var for var in targets if var is not None]
             for i, t in enumerate(tvals):
                 vidx = tuple(v._args[0:idx2]) + (t,) + \
                        tuple(v._args[idx2 + 1:])
-                
-                local_name = v._base.local_name
-                if scenario_idx is None:
-                    model.component(v._base.local_name)[vidx].set_value(valinit[i])
-                else:
-                    for s_idx in stages_to_update(scenario_idx):
-                        var = utils.get_scenario(model, s_idx).component(v._base.local_name)
-                        if var is not None:
-                            var[vidx].set_value(valinit[i])
-                        else:
-                            continue
+                for var in targets:
+                    handles.append(var[vidx])
+                    positions.append(idx*len(tvals) + i)
+
+        cache[scenario_idx] = (np.array(tvals), handles, np.array(positions, dtype=int))
+        return cache[scenario_idx]
 
     # def _collect_output(self, model):
     #     container = {
@@ -119,7 +209,7 @@ class Simulator:
         return container
 
     def get_sim_result(self):
-        return (self.simulator_obj._tsim, self.simulator_obj._simsolution)
+        return (self.simulator_obj._tsim.copy(), self.simulator_obj._simsolution.copy())
    
     # def _update_input(self, input_values):
     #     for stage, value in input_values.items():
@@ -133,4 +223,10 @@ class Simulator:
         if self.model_transformation is not None:
             self.model_transformation(self.model)
 
-        
\ No newline at end of file
+def interp_columns(x, xp, fp):
+    """Equivalent of np.interp(x, xp, fp[:, j]) for all columns j of fp at once."""
+    i = np.clip(np.searchsorted(xp, x, side='right'), 1, len(xp)-1)
+    dx = xp[i] - xp[i-1]
+    w = np.divide(x - xp[i-1], dx, out=np.ones(len(x)), where=dx>0)
+    w = np.clip(w, 0, 1)[:, None]
+    return fp[i-1]*(1-w) + fp[i]*w
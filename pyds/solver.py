@@ -1,11 +1,57 @@
 from pyomo.core.base import param
 from pyomo.core.base.transformation import TransformationFactory
 from pyomo.opt import (SolverFactory,  TerminationCondition)
+from pyomo.core.base import Var, value
+from scipy.spatial import cKDTree
 import numpy
 import pickle
+import inspect
 import os
 
 import pyds.utils as utils
+from pyds.cache import LRUCache
+from pyds.profiling import profiler
+
+OPTIMAL = (TerminationCondition.optimal, TerminationCondition.locallyOptimal, TerminationCondition.globallyOptimal)
+
+class _WarmstartIndex:
+    """Nearest neighbour search over the cached input points of one set of branching factors.
+
+    Points stored after the k-d tree was built are searched linearly, until they exceed a quarter
+    of the tree and it is rebuilt. Keys which were evicted from the cache are skipped.
+    """
+    def __init__(self, keys):
+        points = numpy.array([k[1] for k in keys])
+        self.scale = numpy.std(points, axis=0)
+        self.scale[self.scale == 0] = 1
+        self.tree = cKDTree(points/self.scale)
+        self.keys = keys
+        self.pending = []
+
+    def add(self, key):
+        self.pending.append(key)
+
+    def is_outdated(self):
+        return len(self.pending) > len(self.keys)//4
+
+    def query(self, point, cache):
+        """Return the scaled distance and the key of the nearest cached point"""
+        point = point/self.scale
+        nearest = (numpy.inf, None)
+        k = 1
+        while nearest[1] is None and k <= 2*len(self.keys):
+            dists, idx = self.tree.query(point, k=min(k, len(self.keys)))
+            for dist, i in zip(numpy.atleast_1d(dists), numpy.atleast_1d(idx)):
+                if self.keys[i] in cache:
+                    nearest = (dist, self.keys[i])
+                    break
+            k *= 2
+        for key in self.pending:
+            dist = numpy.linalg.norm(numpy.array(key[1])/self.scale - point)
+            if dist < nearest[0] and key in cache:
+                nearest = (dist, key)
+        return nearest
+
 
 class Solver():
     def __init__(self, parent, config):
@@ -13,6 +59,9 @@ class Solver():
         self.tee = config['tee']
         config.setdefault('use relaxation', True)
         self.use_relaxation = config['use relaxation']
+        #Build the EF with continuous indicator variables instead of relaxing it after construction
+        config.setdefault('relax on construction', True)
+        self.relax_on_construction = config['relax on construction']
         self.io_options = config['io options']
         self.io_options.setdefault('warmstart', True) #Required for solution!
         self.solve_trajectories = config['solve trajectories']
@@ -20,10 +69,51 @@ class Solver():
         self.save_output = config['save output']
         self.save_solution_states = config['save solution state']
         self.no_infeasible = 0
+        self.no_skipped_trajectories = 0
+        self._has_solution = True
+
+        #Reuse the relaxation as trajectory solution if its indicator variables are already integral
+        config.setdefault('skip integral trajectories', True)
+        config.setdefault('integrality tolerance', 1e-6)
+        self.skip_integral = config['skip integral trajectories']
+        self.integrality_tol = config['integrality tolerance']
+
+        #Solutions of evaluated input points, used to warm start nearby points. Points further than 
+        #the max distance, in standard deviations of the cached points per input, are simulated.
+        config.setdefault('warmstart cache size', 0)
+        config.setdefault('warmstart max distance', None)
+        self.warmstart_cache = LRUCache(config['warmstart cache size'])
+        self.warmstart_max_distance = config['warmstart max distance']
+        self._warmstart_trees = {}
         
-        self.solver_obj = SolverFactory(config['name'])
+        self.name = config['name']
+        self.solver_obj = SolverFactory(self.name)
+
+        #Persistent interfaces keep the written model between solves and only update changed values
+        config.setdefault('persistent', False)
+        self.persistent = config['persistent']
+        if self.persistent:
+            from pyomo.contrib.appsi.base import PersistentSolver
+            if not isinstance(self.solver_obj, PersistentSolver):
+                raise ValueError('Solver {} has no persistent interface, use e.g. appsi_ipopt'.format(config['name']))
+            #The io options are passed to the solve call, solver options as io option 'options'
+            solve_args = inspect.signature(self.solver_obj.solve).parameters
+            unsupported = [k for k in self.io_options if k not in solve_args or k in ['model', 'tee', 'load_solutions']]
+            if len(unsupported):
+                raise ValueError('The io options {} are not supported by the persistent interface of {}'.format(
+                    unsupported, config['name']))
+
+        #Keep one written problem per model and branching factors, of which only the values are updated
+        config.setdefault('template cache', True)
+        self.template_cache = config['template cache']
+
+    def solve(self, input_values=None):
+        """Solve the EF of the parent. 
 
-    def solve(self):
+        Args:
+            input_values (dict): The input loaded into the model. If given, the solution is added to 
+                the warm start cache.
+        """
         self.result = None
         self.model = self.parent.model
 
@@ -32,87 +122,211 @@ class Solver():
             'trajectories': None,
         }
         if self.use_relaxation:
-            if not hasattr(self.parent.model, '_relaxed_integer_vars'):
-                TransformationFactory('core.relax_integer_vars').apply_to(self.parent.model)
+            model = self.parent.model
+            if not (hasattr(model, '_relaxed_integer_vars') or getattr(model, '_relax_integer_vars', False)):
+                TransformationFactory('core.relax_integer_vars').apply_to(model)
             #http://www.pyomo.org/blog/2015/1/8/accessing-solver
             self._solve_relaxation()
-            if (self.result['Solver'].termination_condition == TerminationCondition.infeasible):
+            if (self.result['Solver'].termination_condition == TerminationCondition.infeasible
+                    or not self._has_solution):
                 self._set_infeasible_indicator_var()
                 self.no_infeasible += 1 
+                profiler.count('infeasible solves')
                 if self.warn_infeasible:    
                     print('Warning: Infeasible relaxation. Total number of infeasible solves: {}'.format(self.no_infeasible))
                 return
         
         if self.solve_trajectories and self.save_output:
-            self._solve_trajectories()
-            self.output['trajectories'] = self._collect_output().copy()
+            if self.use_relaxation and self.skip_integral and self._relaxation_is_integral:
+                with profiler.timer('output collection'):
+                    self.output['trajectories'] = self._collect_output().copy()
+                self.no_skipped_trajectories += 1
+                profiler.count('skipped solves')
+                if self.tee:
+                    print('Integral relaxation, trajectory solve skipped. Total number of skipped solves: {}'.format(
+                        self.no_skipped_trajectories))
+            else:
+                self._solve_trajectories()
+
+        if input_values is not None and self.warmstart_cache.maxsize:
+            self._store_warmstart(input_values)
+
+    def load_warmstart(self, input_values):
+        """Initialize the variables of the parent model from the cached solution of the nearest 
+        input point with the same branching factors, if it is within the warmstart max distance.
+
+        Returns:
+            bool: True if the model was initialized
+        """
+        if not self.warmstart_cache.maxsize:
+            return False
+        model = self.parent.model
+        BFs = tuple(model.BFs)
+        if BFs not in self._warmstart_trees:
+            keys = [k for k in self.warmstart_cache.keys() if k[0] == BFs]
+            if len(keys) == 0:
+                return False
+            self._warmstart_trees[BFs] = _WarmstartIndex(keys)
+        dist, key = self._warmstart_trees[BFs].query(self._warmstart_point(model, input_values), self.warmstart_cache)
+        if key is None:
+            return False
+        if self.warmstart_max_distance is not None and dist > self.warmstart_max_distance:
+            profiler.count('distant warm starts')
+            return False
+        values = self.warmstart_cache[key]
+        #Variables without a value in the solution are stored as NaN and keep their initial value
+        for var, var_value in zip(self._warmstart_vars(model), values):
+            if not var.fixed and numpy.isfinite(var_value):
+                var.set_value(var_value, skip_validation=True)
+        return True
+
+    def _store_warmstart(self, input_values):
+        model = self.model
+        BFs = tuple(model.BFs)
+        key = (BFs, tuple(self._warmstart_point(model, input_values)))
+        self.warmstart_cache[key] = numpy.array([var.value for var in self._warmstart_vars(model)], dtype=float)
+        index = self._warmstart_trees.get(BFs)
+        if index is not None:
+            index.add(key)
+            if index.is_outdated():
+                del self._warmstart_trees[BFs]
+
+    def _warmstart_point(self, model, input_values):
+        point = []
+        for stage in sorted(input_values.keys()):
+            n_scenarios = len(utils.scenarios_at_stage(model, stage))
+            point.extend(numpy.asarray(input_values[stage])[0:n_scenarios].ravel())
+        return numpy.array(point, dtype=float)
+
+    def _warmstart_vars(self, model):
+        cache = utils.model_cache(model, 'warmstart')
+        BFs = tuple(model.BFs)
+        if BFs not in cache:
+            cache[BFs] = list(model.component_data_objects(Var, active=True, descend_into=True))
+        return cache[BFs]
+
+    def _run_solver(self):
+        profiler.count('solves')
+        self._has_solution = True
+        if not self.persistent:
+            return self.solver_obj.solve(self.model, tee=self.tee, io_options=self.io_options)
+        solver_obj = self._get_template()
+        result = solver_obj.solve(self.model, tee=self.tee, load_solutions=False, **self.io_options)
+        #Without a feasible point, e.g. after maxIterations, APPSI has no solution to load
+        self._has_solution = result['Solver'].termination_condition in OPTIMAL or len(result.solution) > 0
+        if self._has_solution:
+            solver_obj.load_vars()
+        return result
+
+    def _get_template(self):
+        """Get the persistent solver which holds the written problem of the model at its current 
+        branching factors. The structure of the EF is fixed after construction, so only the values
+        of the mutable parameters, the variables and the objective are updated before a solve.
+        """
+        if not self.template_cache:
+            return self.solver_obj
+        cache = utils.model_cache(self.model, 'template')
+        BFs = tuple(self.model.BFs)
+        if BFs not in cache:
+            solver_obj = SolverFactory(self.name)
+            update = solver_obj.update_config
+            update.check_for_new_or_removed_constraints = False
+            update.check_for_new_or_removed_vars = False
+            update.check_for_new_or_removed_params = False
+            update.update_constraints = False
+            update.update_named_expressions = False
+            cache[BFs] = solver_obj
+        return cache[BFs]
+
+    def _get_user_time(self):
+        user_time = self.result['Solver'][0]['User time']
+        return user_time if isinstance(user_time, (int, float)) else None
 
     def _solve_relaxation(self):
         self._reset_indicator_var()
-        self.result = self.solver_obj.solve(self.model, tee=self.tee, io_options=self.io_options)   
+        with profiler.timer('relaxation solve'):
+            self.result = self._run_solver()
         if self.save_output:
-            self.output['relaxation'] = self._collect_output().copy()
+            with profiler.timer('output collection'):
+                self.output['relaxation'] = self._collect_output().copy()
+        values = self._get_indicator_var_values()[utils.get_indicator_vars(self.model)[1]]
+        #Fixing the indicators does not change an integral solution, values are fixed to 1 unless exactly 0.
+        #A relaxation which did not converge, e.g. after maxIterations, is never reused.
+        self._relaxation_is_integral = self.result['Solver'].termination_condition in OPTIMAL and \
+            bool(numpy.all((values == 0) | (numpy.abs(values - 1) <= self.integrality_tol)))
         self._fix_indicator_var()
 
     def _solve_trajectories(self):
-        self.result = self.solver_obj.solve(self.model, tee=self.tee, io_options=self.io_options)
+        with profiler.timer('trajectory solve'):
+            self.result = self._run_solver()
         if self.save_output:
-            self.output['trajectories'] = self._collect_output().copy()
+            with profiler.timer('output collection'):
+                self.output['trajectories'] = self._collect_output().copy()
 
     #Set all indicator variables to 1 if the solution is infeasible
     def _set_infeasible_indicator_var(self): 
-        for scen in utils.get_final_scenarios(self.model):
-            if hasattr(scen, '_indicator_var'):
-                var = scen._indicator_var
-                var.fix(1.0)
-            else:
-                continue
+        indicator_vars, mask = utils.get_indicator_vars(self.model)
+        for var in indicator_vars:
+            var.fix(1.0)
 
     def _fix_indicator_var(self):
-        for scen in utils.get_final_scenarios(self.model):
-            if hasattr(scen, '_indicator_var'):
-                var = scen._indicator_var
-                if var.value==0:
-                    var.fix(0)
-                else:
-                    var.fix(1)
-            else:
-                continue
+        indicator_vars, mask = utils.get_indicator_vars(self.model)
+        values = numpy.where(self._get_indicator_var_values()[mask] == 0, 0, 1).tolist()
+        for var, var_value in zip(indicator_vars, values):
+            var.fix(var_value)
     
     def _reset_indicator_var(self):
-        for scen in utils.get_final_scenarios(self.model):
-            if hasattr(scen, '_indicator_var'):
-                var = scen._indicator_var
-                var.unfix()
-                var.set_value(0)
-            else:
-                continue
+        indicator_vars, mask = utils.get_indicator_vars(self.model)
+        for var in indicator_vars:
+            var.unfix()
+            var.set_value(0)
     
     def _get_indicator_var_values(self):
-        final_scenarios = utils.get_final_scenarios(self.model)
-        vars = numpy.empty(len(final_scenarios))
-        
-        for id, scen in enumerate(final_scenarios):
-             if hasattr(scen, '_indicator_var'):
-                 vars[id] = scen._indicator_var.value
+        indicator_vars, mask = utils.get_indicator_vars(self.model)
+        vars = numpy.empty(len(mask))
+        vars[mask] = [var.value for var in indicator_vars]
         return vars
 
     def _collect_output(self):
+        handles, labels = self._get_output_handles()
+        data = numpy.array([value(h, exception=False) for h in handles.flat], dtype=float)
         container = {
-            'data': [],
+            'data': data.reshape(handles.shape),
+            'labels': labels,
             'objective': None,
-            'user time': self.result['Solver'][0]['User time'],
+            'user time': self._get_user_time(),
              #'result': self.result, #Disabled due to pickling weakref error
             'infeasible': self.result['Solver'].termination_condition == TerminationCondition.infeasible
         }
         container['objective'] = utils.parse_value(self.model, 'obj')
-        all_idx = utils.get_all_idx(self.model.BFs)
-        for i, idx in enumerate(all_idx):
-            v = {}
+        return container
+
+    def _get_output_handles(self):
+        """Compile the output map into a fixed ordering of data objects, cached on the model.
+
+        Returns:
+            tuple of 2d array, list: The data objects of shape (n_scenarios, n_values) and a 
+                (stage, name, index) label per value.
+        """
+        cache = utils.model_cache(self.model, 'output')
+        BFs = tuple(self.model.BFs)
+        if BFs not in cache:
+            all_idx = list(utils.get_all_idx(BFs))
+            labels = []
             for stage, names in self.parent.output_map.items():
-                scen = utils.get_scenario(self.model, idx[0:stage+1])
+                if isinstance(names, str):
+                    names = [names]
                 for n in names:
-                    v[n] = utils.parse_value(scen, n)
-            container['data'].append(v.copy())
-        return container
+                    c = utils.get_scenario(self.model, all_idx[0][0:stage+1]).component(n)
+                    if c is None:
+                        continue
+                    keys = list(c.keys()) if c.is_indexed() else [None]
+                    labels.extend([(stage, n, k) for k in keys])
 
+            handles = numpy.empty((len(all_idx), len(labels)), dtype=object)
+            for i, idx in enumerate(all_idx):
+                for j, (stage, n, k) in enumerate(labels):
+                    c = utils.get_scenario(self.model, idx[0:stage+1]).component(n)
+                    handles[i, j] = c if k is None else c[k]
+            cache[BFs] = (handles, labels)
+        return cache[BFs]
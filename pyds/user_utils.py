@@ -1,4 +1,9 @@
 import pickle
+from os import listdir
+from os.path import join, exists, splitext
+import json
+
+import numpy as np
 
 def read_output_file(filepath):
     objs = []
@@ -11,6 +16,8 @@ def read_output_file(filepath):
     return objs
 
 def read_last_file(filepath):
+    if exists(splitext(filepath)[0] + '.idx'):
+        return OutputReader(filepath).read_last()
     prev_obj = None
     with open(filepath, 'rb+') as f:
         while True:
@@ -18,4 +25,125 @@ def read_last_file(filepath):
                 prev_obj = pickle.load(f)
             except EOFError:
                 break
-    return prev_obj
\ No newline at end of file
+    return prev_obj
+
+def read_labels(filepath):
+    """Read the labels of the solver output values of a pickle output file, per phase"""
+    with open(splitext(filepath)[0] + '.labels.json') as f:
+        return json.load(f)
+
+def build_index(filepath, design_stage=None):
+    """Write the sidecar index of a pickle output file which has none, by scanning it once."""
+    from pyds.output_manager import PickleWriter
+    writer = PickleWriter(filepath + '.tmp', splitext(filepath)[0] + '.idx', design_stage)
+    with open(filepath, 'rb') as f:
+        while True:
+            offset = f.tell()
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            writer._write_index(record, offset, f.tell() - offset)
+            writer.n_records += 1
+    writer.flush()
+
+class OutputReader:
+    """Random-access reader for pickle output files, through their sidecar index.
+
+    Args:
+        filepath (str): The .pkl output file. The index is expected next to it, with the 
+            .idx extension.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        index_path = splitext(filepath)[0] + '.idx'
+        width = int(np.fromfile(index_path, dtype=np.int64, count=1)[0])
+        self.index = np.memmap(index_path, dtype=np.float64, mode='r', offset=8).reshape(-1, width)
+        self.file = open(filepath, 'rb')
+
+    def __len__(self):
+        if len(self.index) == 0:
+            return 0
+        return int(self.index[-1, 0]) + 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.read_record(i)
+
+    def _row(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Record index out of range')
+        return int(np.searchsorted(self.index[:, 0], i))
+
+    def read_record(self, i):
+        row = self.index[self._row(i)]
+        self.file.seek(int(row[1]))
+        return pickle.loads(self.file.read(int(row[2])))
+
+    def read_last(self):
+        return self.read_record(-1)
+
+    def read_range(self, start, stop):
+        return [self.read_record(i) for i in range(start, min(stop, len(self)))]
+
+    def design_points(self):
+        """Get the record number and coordinates of every indexed design point
+
+        Returns:
+            tuple of 1d array, 2d array: The record numbers and the design point coordinates
+        """
+        return self.index[:, 0].astype(int), np.asarray(self.index[:, 4:])
+
+    def close(self):
+        self.file.close()
+
+class ChunkedOutputReader:
+    """Reader for the chunked output format. Fields are memory-mapped and records are only
+    sliced from the chunk which contains them.
+
+    Args:
+        path (str): The .chunks output folder
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(join(path, 'schema.json')) as f:
+            self.schema = json.load(f)
+        self.chunks = sorted(i for i in listdir(path) if i.startswith('chunk_'))
+        self.fields = []
+        n_records = []
+        for chunk in self.chunks:
+            with open(join(path, chunk, 'chunk.json')) as f:
+                info = json.load(f)
+            self.fields.append(info['fields'])
+            n_records.append(info['n_records'])
+        self.starts = np.cumsum([0] + n_records)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Record index out of range')
+        c = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return {name: self.read_field(name, c)[i - self.starts[c]] for name in self.fields[c]}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def read_field(self, name, chunk):
+        """Get the memory-mapped values of a field in a chunk, split per record.
+
+        Returns:
+            list of array: The values per record, empty if the record has none.
+        """
+        folder = join(self.path, self.chunks[chunk])
+        values = np.load(join(folder, name + '.npy'), mmap_mode='r')
+        offsets = np.load(join(folder, name + '.offsets.npy'))
+        return [values[offsets[j]:offsets[j+1]] for j in range(len(offsets)-1)]
@@ -1,10 +1,14 @@
-from pyomo.core.base import (ConcreteModel, Block, RangeSet, Constraint, ConstraintList, Param, Var)
+from pyomo.core.base import (ConcreteModel, Block, Set, Constraint, ConstraintList, Param, Var)
 from pyomo.core.base.objective import Objective, maximize
-from pyomo.core.base.set import Binary
+from pyomo.core.base.set import Binary, UnitInterval
+from pyomo.core.base import value
+from pyomo.core.expr.visitor import identify_variables
+from pyomo.util.calc_var_value import calculate_variable_from_constraint
 from itertools import product
 from math import prod
+import numpy as np
 
-def add_BigMConstraint(model, name, bigM_constant, *args, **kwargs):
+def add_BigMConstraint(model, name, bigM_constant, *args, screening_scale=None, **kwargs):
     """Obtain the big-M form of an (in)equality constraint.
 
     Args:
@@ -14,6 +18,9 @@ def add_BigMConstraint(model, name, bigM_constant, *args, **kwargs):
             constraints are satisfied.
         bigM_constant (pyomo.core.base.Param): Big-M constant which is scaled to the magnitude 
             of the inequality constraint.
+        screening_scale (float): Typical magnitude of the constraint violation, used to scale 
+            the residuals of the scenario screening. Defaults to the magnitude of the bound, 
+            at least 1.
     Returns:
         :pyomo.core.base.Constraint | pyomo.core.base.ConstraintList | None : 
             The constraint in big-m form.
@@ -21,7 +28,9 @@ def add_BigMConstraint(model, name, bigM_constant, *args, **kwargs):
     constraint = Constraint(*args, **kwargs)
     constraint.construct()
     if not hasattr(model, '_indicator_var'):
-        model._indicator_var = Var(initialize=0, within=Binary, bounds=(0,1))
+        #Created continuous if the EF is built relaxed, so no relaxation pass is needed
+        domain = UnitInterval if getattr(model.model(), '_relax_integer_vars', False) else Binary
+        model._indicator_var = Var(initialize=0, within=domain, bounds=(0,1))
     indicator_var = model._indicator_var
 
     if (constraint.lower is None) & (constraint.upper is not None):
@@ -42,6 +51,14 @@ def add_BigMConstraint(model, name, bigM_constant, *args, **kwargs):
         cstr =  None
 
     model.add_component(name, cstr)
+    #The original constraint is kept to screen scenarios without a solve
+    if cstr is not None:
+        if not hasattr(model, '_bigM_constraints'):
+            model._bigM_constraints = []
+        if screening_scale is None:
+            bounds = [abs(value(b)) for b in [constraint.lower, constraint.upper] if b is not None]
+            screening_scale = max(bounds + [1.0])
+        model._bigM_constraints.append((constraint, screening_scale))
     
 def _create_objective(m):
     def obj_rule(m):
@@ -66,14 +83,19 @@ def get_all_idx(BFs):
     return product(*[range(i) for i in BFs])
 
 def scenarios_at_stage(m, stage):
-    """Get an interator which gives index, scenario 
+    """Get a list of all active scenarios at a stage. The list is cached on the model 
+    and must not be modified.
 
     Args:
         m (ConcreteModel): The multi-stage model
         stage (int): target stage
     """
-    BFs = m.BFs[0:stage+1]
-    return [get_scenario(m, i) for i in get_all_idx(BFs)]
+    BFs = tuple(m.BFs[0:stage+1])
+    cache = _scenario_index(m)['stages']
+    if BFs not in cache:
+        index = _scenario_index(m)['scenarios']
+        cache[BFs] = [index[i] for i in get_all_idx(BFs)]
+    return cache[BFs]
 
 def get_scenario(m, idx):
     """Get a single scenario by idx
@@ -81,18 +103,139 @@ def get_scenario(m, idx):
         m (ConcreteModel): Pyomo model
         idx (list or tuple of int): scenario index
     """
-    def recursive(obj, stage, idx):
-        if stage == len(idx)-1:
-            return obj
-        else:
-            obj = obj.__getattribute__('Substage')[idx[stage+1]]
-            return recursive(obj, stage+1, idx)
-    return recursive(m, 0, idx)    
+    return _scenario_index(m)['scenarios'][tuple(idx)]
+
+def get_indicator_vars(m):
+    """Get the indicator variables of the active final scenarios. Cached on the model for the 
+    active branching factors.
+
+    Args:
+        m (ConcreteModel): The multi-stage model
+
+    Returns:
+        tuple of list of VarData, 1d bool array: The indicator variables and a mask of 
+            the final scenarios which have one.
+    """
+    key = tuple(m.BFs)
+    cache = _scenario_index(m)['indicators']
+    if key not in cache:
+        scenarios = get_final_scenarios(m)
+        mask = np.array([hasattr(scen, '_indicator_var') for scen in scenarios], dtype=bool)
+        indicator_vars = [scen._indicator_var for scen, has_var in zip(scenarios, mask) if has_var]
+        cache[key] = (indicator_vars, mask)
+    return cache[key]
+
+def get_bigM_residuals(m):
+    """Evaluate the original form of the big-M constraints of the active final scenarios at the
+    current variable values. Variables in the constraint bodies which are defined by a scalar 
+    equality constraint of the scenario block, like the CQAs, are calculated from it first.
+
+    Args:
+        m (ConcreteModel): The multi-stage model
+
+    Returns:
+        1d array: The largest violation of the constraints of every final scenario, divided by 
+            the screening scale of the constraint. Negative if all constraints are satisfied, nan 
+            if the scenario has no big-M constraints or a definition could not be evaluated.
+    """
+    cache = model_cache(m, 'bigM')
+    key = tuple(m.BFs)
+    if key not in cache:
+        cache[key] = [_get_bigM_definitions(scen) for scen in get_final_scenarios(m)]
+
+    residuals = np.full(len(cache[key]), np.nan)
+    for i, (definitions, constraints) in enumerate(cache[key]):
+        if len(constraints) == 0:
+            continue
+        try:
+            for var, con in definitions:
+                calculate_variable_from_constraint(var, con)
+        except (ValueError, ArithmeticError, RuntimeError):
+            continue
+        r = []
+        for con, scale in constraints:
+            body = value(con.body, exception=False)
+            if body is None:
+                r = [np.nan]
+                break
+            if con.upper is not None:
+                r.append((body - value(con.upper))/scale)
+            if con.lower is not None:
+                r.append((value(con.lower) - body)/scale)
+        residuals[i] = max(r)
+    return residuals
+
+def _get_bigM_definitions(scen):
+    #Scalar equality constraints of the form var == expression define var
+    constraints = getattr(scen, '_bigM_constraints', [])
+    lhs = {}
+    for c in scen.component_data_objects(Constraint, active=True, descend_into=False):
+        if c.equality and not c.parent_component().is_indexed():
+            var = c.expr.args[0]
+            if getattr(var, 'is_variable_type', lambda: False)() and not var.fixed:
+                lhs[id(var)] = (var, c)
+
+    definitions = []
+    defined = set()
+    def define(var):
+        if id(var) not in lhs or id(var) in defined:
+            return
+        defined.add(id(var))
+        var, c = lhs[id(var)]
+        for v in identify_variables(c.expr.args[1]):
+            define(v)
+        definitions.append((var, c))
+    for con, scale in constraints:
+        for var in identify_variables(con.body):
+            define(var)
+    return definitions, constraints
+
+def model_cache(m, name):
+    """Get a named cache dict which is stored on the model and discarded together with it."""
+    return _scenario_index(m).setdefault(name, {})
+
+def index_scenarios(m):
+    """(Re)build the scenario index of a model, which maps every scenario tuple to its block.
+
+    The index is stored on the model, so it is discarded together with the model when it is 
+    rebuilt. It covers all scenario blocks, including the ones which are deactivated.
+
+    Args:
+        m (ConcreteModel): Pyomo model
+    """
+    scenarios = {}
+    def recursive(obj, idx):
+        scenarios[idx] = obj
+        if len(idx) == len(m.BFs) or obj.component('Substage') is None:
+            return
+        for i in obj.Substage_idx:
+            recursive(obj.Substage[i], idx + (i,))
+    recursive(m, (0,))
+    m._scenario_index = {'scenarios': scenarios, 'stages': {}, 'inputs': {}, 'indicators': {}}
+    return m._scenario_index
+
+def _scenario_index(m):
+    index = getattr(m, '_scenario_index', None)
+    if index is None:
+        index = index_scenarios(m)
+    return index
         
-def create_EF(stage_rules, BFs):
+def create_EF(stage_rules, BFs, relax_integer_vars=False, model_transformation=None):
+    """Create the extensive form of a multi-stage model.
+
+    Args:
+        stage_rules (list of callable): Rule per stage, called with the stage block and a dict of 
+            the parent stage blocks.
+        BFs (list of int): Branching factors
+        relax_integer_vars (bool): Create the indicator variables as continuous variables in 
+            [0, 1]. Other integer variables of the stage rules are not relaxed.
+        model_transformation (callable): Applied to the model, e.g. the discretization. It may 
+            also be applied after create_EF.
+    """
     ef = ConcreteModel()
     ef.n_stages = len(BFs)
     ef.BFs = BFs
+    ef._relax_integer_vars = relax_integer_vars
     stages_dict = {}
 
     if ef.n_stages == 1:
@@ -103,14 +246,88 @@ def create_EF(stage_rules, BFs):
         if stage == len(BFs)-1: #Check whether last stage has been reached
             return
         stages_dict[stage] = m
-        m.add_component('Substage_idx', RangeSet(0, BFs[stage+1]-1))
+        #Substages can be added to the index set by grow_EF, which fills their empty blocks
+        m.add_component('Substage_idx', Set(initialize=range(BFs[stage+1])))
         m.add_component('Substage', Block(m.Substage_idx, 
-            rule= lambda m: recursive_block_rule(m, stage+1, BFs, stages_dict)))
+            rule= lambda m: recursive_block_rule(m, stage+1, BFs, stages_dict) 
+                if m.index() < BFs[stage+1] else None))
 
-    recursive_block_rule(ef, 0, ef.BFs, stages_dict)
+    recursive_block_rule(ef, 0, tuple(BFs), stages_dict)
+    if model_transformation is not None:
+        model_transformation(ef)
+    index_scenarios(ef)
     _create_objective(ef)
+    ef.capacity_BFs = list(BFs)
     return ef
 
+def _clone_substages(m, stage, n_stages, start=1):
+    #Components outside of the cloned block, like the parent stages, are shared by the clones
+    if stage == n_stages-1:
+        return
+    template = m.Substage[0]
+    _clone_substages(template, stage+1, n_stages)
+    for i in m.Substage_idx:
+        if i >= start:
+            m.Substage[i].transfer_attributes_from(template.clone())
+
+def grow_EF(m, BFs):
+    """Grow the capacity of an EF in place by cloning the first substage of every stage into the 
+    new substages, so the existing scenarios are not rebuilt or transformed again. The active 
+    branching factors are unchanged. The model transformation must have been applied, and the 
+    stage rules must build the same block for every substage, which differ in their input 
+    parameter values only.
+
+    Args:
+        m (ConcreteModel): The multi-stage model, created with create_EF
+        BFs (list of int): New capacity, at least the current capacity
+    """
+    capacity = [int(i) for i in np.maximum(m.capacity_BFs, BFs)]
+
+    def recursive(obj, stage):
+        if stage == m.n_stages-1:
+            return
+        for i in obj.Substage_idx:
+            recursive(obj.Substage[i], stage+1)
+        n = len(obj.Substage_idx)
+        for i in range(n, capacity[stage+1]):
+            obj.Substage_idx.add(i)
+        _clone_substages(obj, stage, stage+2, start=n)
+
+    recursive(m, 0)
+    m.capacity_BFs = capacity
+    index_scenarios(m)
+    resize_EF(m, m.BFs)
+
+def resize_EF(m, BFs):
+    """Resize an EF in place by (de)activating scenario blocks.
+
+    The EF must have been built with create_EF at branching factors which are at least as 
+    large as BFs. Only the first BFs[i] substages of every stage remain active, the objective 
+    is rebuilt over the active scenarios.
+
+    Args:
+        m (ConcreteModel): The multi-stage model
+        BFs (list of int): Target branching factors
+    """
+    capacity = m.capacity_BFs
+    if len(BFs) != len(capacity) or any(b > c for b, c in zip(BFs, capacity)):
+        raise ValueError('Branching factors {} exceed the model capacity {}'.format(list(BFs), capacity))
+
+    def recursive(obj, stage):
+        if stage == m.n_stages-1:
+            return
+        for i in obj.Substage_idx:
+            if i < BFs[stage+1]:
+                obj.Substage[i].activate()
+                recursive(obj.Substage[i], stage+1)
+            else:
+                obj.Substage[i].deactivate()
+
+    recursive(m, 0)
+    m.BFs = list(BFs)
+    m.del_component(m.obj)
+    _create_objective(m)
+
 def create_flattened_model(stage_rules):
     m = ConcreteModel()
     m.BFs = [1]*(len(stage_rules))
@@ -128,10 +345,38 @@ def load_input(model, input_map, input_values):
         """
         for stage, values in input_values.items():
             if not stage in input_map.keys():
-                raise ValueError('Undefined input binding: ' + str(stage))        
-            for param_idx, param_name in enumerate(input_map[stage]):
-                for scen_count, scen in enumerate(scenarios_at_stage(model, stage)): #Scenario
-                    scen.component(param_name).set_value(values[scen_count, param_idx])
+                raise ValueError('Undefined input binding: ' + str(stage))
+            params = bind_input(model, input_map[stage], stage)
+            #Like indexing per scenario and parameter, surplus rows and columns are ignored
+            values = np.asarray(values)[0:params.shape[0], 0:params.shape[1]]
+            if values.shape != params.shape:
+                raise ValueError('Input of shape {} at stage {} does not cover the {} scenarios and {} parameters'.format(
+                    values.shape, stage, *params.shape))
+            for param, param_value in zip(params.flat, values.flat):
+                param.set_value(param_value)
+
+def bind_input(model, names, stage):
+    """Get the parameters which are bound to the input of a stage. The binding is cached on the 
+    model for the active branching factors.
+
+    Args:
+        model (ConcreteModel): The multi-stage model
+        names (list of str): Parameter names, as in the input map
+        stage (int): target stage
+
+    Returns:
+        2d array of ParamData: Rows are the scenarios at the stage, columns the parameters. 
+    """
+    key = (stage, tuple(names), tuple(model.BFs[0:stage+1]))
+    cache = _scenario_index(model)['inputs']
+    if key not in cache:
+        scenarios = scenarios_at_stage(model, stage)
+        params = np.empty((len(scenarios), len(names)), dtype=object)
+        for scen_count, scen in enumerate(scenarios):
+            for param_idx, param_name in enumerate(names):
+                params[scen_count, param_idx] = scen.component(param_name)
+        cache[key] = params
+    return cache[key]
               
 def parse_value(m, name):
     """Return a dict which contains the values of all variables, objectives and parameters. 
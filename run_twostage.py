@@ -153,7 +153,7 @@ the_activity_form = {
             # "score_evaluation": {
             #     "method": "mppool",
             #     "pool_size": -1,
-            #     "constraints_func_ptr": None,
+            #     "constraints_func_ptr": m.g,
             #     "store_constraints": False
             # },
             "efp_evaluation": {
@@ -166,7 +166,7 @@ the_activity_form = {
             # "efp_evaluation": {
             #     "method": "mppool",
             #     "pool_size": -1,
-            #     "constraints_func_ptr": None,
+            #     "constraints_func_ptr": m.g,
             #     "store_constraints": False,
             #     "acceleration": False
             # },
@@ -0,0 +1,75 @@
+import pyomo.environ as pyo
+from pyomo.opt import SolverFactory
+import numpy as np
+import pytest
+
+from pyds.utils import add_BigMConstraint
+from pyds.run import TwoStageManager
+
+def design_rule(m, stage=None):
+    m.d = pyo.Param(initialize=0, mutable=True)
+
+def parameter_rule(m, stage):
+    m.p = pyo.Param(initialize=0, mutable=True)
+    m.x = pyo.Var(initialize=0)
+    m.c_x = pyo.Constraint(expr=m.x == stage[0].d*m.p)
+    m.bigM_constant = pyo.Param(initialize=1E2)
+    add_BigMConstraint(m, 'g1', m.bigM_constant, expr=m.x <= 1)
+
+def get_config(output_folder, io_options=None, template_cache=True, solver='appsi_ipopt'):
+    return {
+        'problem': {
+            'stage rules': [design_rule, parameter_rule],
+            'model transformation': None,
+            'input map': {0: ['d'], 1: ['p']},
+            'output map': {1: ['x']},
+            'output folder': str(output_folder)
+        },
+        'solver': {
+            'name': solver,
+            'persistent': True,
+            'template cache': template_cache,
+            'solve trajectories': False,
+            'tee': False,
+            'io options': {'warmstart': True} if io_options is None else io_options,
+            'save output': False,
+            'save solution state': False,
+            'warn infeasible': False,
+        },
+        'simulator': {
+            'enabled': False,
+            'package': 'scipy',
+            'suffix name': None,
+            'save output': False,
+            'kwargs': {}
+        }
+    }
+
+def solver_available(name):
+    try:
+        return bool(SolverFactory(name).available(exception_flag=False))
+    except Exception:
+        return False
+
+PERSISTENT_SOLVERS = [pytest.param(name, marks=pytest.mark.skipif(not solver_available(name), 
+    reason='{} is not available'.format(name))) for name in ['appsi_ipopt', 'appsi_highs']]
+
+@pytest.mark.parametrize('solver', PERSISTENT_SOLVERS)
+def test_persistent_template_matches_fresh_solve(tmp_path, solver):
+    """The cached template only updates values, its g must match an interface which checks the
+    whole model for changes"""
+    for folder in ['cached', 'fresh']:
+        (tmp_path/folder).mkdir()
+    cached = TwoStageManager(get_config(tmp_path/'cached', solver=solver))
+    fresh = TwoStageManager(get_config(tmp_path/'fresh', template_cache=False, solver=solver))
+    p = np.array([[0.5], [1.5], [3.0]])
+    for d in [np.array([[0.5]]), np.array([[2.0]])]:
+        g_cached = np.ravel(cached.g(d, p))
+        g_fresh = np.ravel(fresh.g(d, p))
+        np.testing.assert_array_equal(g_cached, g_fresh)
+        #The big-M constraint x <= 1 is violated if d*p > 1
+        np.testing.assert_array_equal(g_cached, -1.0*(d[0, 0]*p[:, 0] > 1))
+
+def test_persistent_rejects_unsupported_io_options(tmp_path):
+    with pytest.raises(ValueError, match='io options'):
+        TwoStageManager(get_config(tmp_path, io_options={'warmstart': True, 'solver': 'conopt'}))